@@ -1,4 +1,5 @@
 import json
+import numpy as np
 from pathlib import Path
 import shutil
 import pytest
@@ -295,3 +296,285 @@ def test_verbose():
 
     cli.main([METHODS[0], WSIS[0]])
     cli.main([METHODS[1], WSIS[0], ANNOTATIONS[0]])
+
+
+def test_annotation_masks_are_not_resized():
+    slide = wp.slide(WSIS[0])
+    annotation = wp.annotation(ANNOTATIONS[0], slide=slide)
+    annotation.make_masks(slide, foreground_fn="otsu", size=500)
+    for mask in annotation.masks.values():
+        assert max(mask.shape) == 500
+    patch_mask = annotation.get_patch_mask("foreground", 100, 200, 256, 128)
+    assert patch_mask.shape == (128, 256)
+    assert 0 <= annotation.coverage("foreground", 100, 200, 256, 128) <= 1
+
+
+def test_annotation_mask_changed_in_place():
+    slide = wp.slide(WSIS[0])
+    annotation = wp.annotation(ANNOTATIONS[0], slide=slide)
+    annotation.make_masks(slide, foreground_fn="otsu")
+    annotation.masks["foreground"][...] = 1
+    annotation.mask_changed("foreground")
+    assert annotation.coverage("foreground", 0, 0, 256, 256) == 1
+    annotation.masks["foreground"][...] = 0
+    assert annotation.coverage("foreground", 0, 0, 256, 256) == 1
+    annotation.mask_changed("foreground")
+    assert annotation.coverage("foreground", 0, 0, 256, 256) == 0
+
+
+def test_no_patches_writes_coords_only():
+    cli.main([METHODS[1], WSIS[0], ANNOTATIONS[0], "-np"])
+    result_dir = Path(Path(WSIS[0]).stem)
+    assert (result_dir/"coords.csv").exists()
+    assert not list((result_dir/"patches").glob("*/*"))
+    remove_result_dir(WSIS[0])
+
+
+def test_worker_type_process():
+    cli.main([METHODS[1], WSIS[0], ANNOTATIONS[0], "-wt", "process"])
+    remove_result_dir(WSIS[0])
+
+
+def test_worker_type_pipeline():
+    cli.main([
+        METHODS[1], WSIS[0], ANNOTATIONS[0], "-wt", "pipeline",
+        "-rw", "2", "-ew", "2", "-ww", "1"])
+    remove_result_dir(WSIS[0])
+
+
+def test_tile_cache():
+    cli.main([
+        METHODS[1], WSIS[0], ANNOTATIONS[0], "-ow", "128", "-oh", "128",
+        "-cs", "64"])
+    remove_result_dir(WSIS[0])
+
+
+def test_tile_cache_non_integer_downsample():
+    # odd sizes make the levels of downsamples such as 2.002
+    path = f"{TESTDIR}/test_odd.tiff"
+    pyvips.Image.new_from_file(WSIS[0]).crop(0, 0, 1001, 999).tiffsave(
+        path, compression="jpeg", pyramid=True, tile=True,
+        tile_width=128, tile_height=128)
+    cached = wp.slide(path, cache_size=1 << 24, tile_size=128)
+    plain = wp.slide(path)
+    for level in range(plain.slide.level_count):
+        for x, y in [(0, 0), (101, 37), (555, 333)]:
+            assert (cached.read_array(x, y, level, 100, 80) ==
+                    plain.read_array(x, y, level, 100, 80)).all()
+    cached.close()
+    plain.close()
+    Path(path).unlink()
+
+
+def test_worker_type_band():
+    cli.main([
+        METHODS[1], WSIS[0], ANNOTATIONS[0], "-wt", "band",
+        "-ow", "64", "-oh", "64", "-ox", "10", "-oy", "20"])
+    remove_result_dir(WSIS[0])
+
+
+def test_slide_crop_many():
+    slide = wp.slide(WSIS[0])
+    coords = [(0, 0), (256, 512), (1000, 300)]
+    batch = slide.crop_many(coords, (256, 128))
+    assert batch.shape == (3, 128, 256, 3)
+    assert batch.dtype == "uint8"
+    for patch, (x, y) in zip(batch, coords):
+        expected = slide.crop(x, y, 256, 128).convert("RGB")
+        assert (patch == np.asarray(expected)).all()
+    # the batch is kept over the next calls unless out is given
+    assert not np.shares_memory(batch, slide.crop_many(coords, (256, 128)))
+    out = np.empty((4, 128, 256, 3), dtype=np.uint8)
+    assert np.shares_memory(out, slide.crop_many(coords, (256, 128), out=out))
+    slide.close()
+
+
+def test_worker_type_stream():
+    cli.main([
+        METHODS[1], WSIS[0], ANNOTATIONS[0], "-wt", "stream",
+        "-ow", "64", "-oh", "64", "-be", "pyvips"])
+    remove_result_dir(WSIS[0])
+
+
+def test_slide_scan_rows():
+    slide = wp.slide(WSIS[0])
+    for top, band in slide.scan_rows([0, 100], 128, 300, left=200):
+        assert band.shape[:2] == (128, 300)
+        assert (band == slide.crop_array(200, top, 300, 128)).all()
+    slide.close()
+
+
+def test_order_hilbert():
+    cli.main([METHODS[1], WSIS[0], ANNOTATIONS[0], "-or", "hilbert"])
+    remove_result_dir(WSIS[0])
+
+
+def test_patcher_rois():
+    slide = wp.slide(WSIS[0])
+    annotation = wp.annotation(ANNOTATIONS[0], slide=slide)
+    annotation.make_masks(slide, foreground_fn="otsu")
+    annotation.classes.remove("foreground")
+    patcher = wp.patcher(
+        slide, "classification", annotation=annotation, no_patches=True,
+        rois=[[0, 0, 2000, 2000]])
+    xs, ys, _, _ = patcher.plan_patches(annotation.classes)
+    assert (xs < 2000).all() and (ys < 2000).all()
+    remove_result_dir(WSIS[0])
+
+
+def test_box_index_query():
+    from wsiprocess.spatial import BoxIndex, pack_boxes
+    coords = [[[0, 0], [10, 10]], [[300, 300], [300, 310], [320, 310],
+                                   [320, 300]], [[0, 0], [5000, 5000]]]
+    boxes = pack_boxes(coords)
+    index = BoxIndex(boxes, cell_size=256, max_cells=4)
+    assert index.query(10, 10, 266, 266).tolist() == [0, 2]
+    assert index.query(256, 256, 512, 512).tolist() == [1, 2]
+    assert index.query(5001, 5001, 5100, 5100).tolist() == []
+
+
+def test_order_bbs():
+    slide = wp.slide(WSIS[0])
+    annotation = wp.annotation()
+    annotation.make_masks(slide, foreground_fn="otsu")
+    patcher = wp.patcher(
+        slide, "evaluation", annotation=annotation, no_patches=True)
+    boxes = np.array([[100, 50, 120, 70], [10, 200, 30, 300],
+                      [5, 50, 20, 60], [1000, 1000, 1100, 1100]])
+    candidates = np.arange(len(boxes))
+    assert patcher.order_bbs(boxes, candidates, 0, 0) == [2, 0, 1]
+    remove_result_dir(WSIS[0])
+
+
+@pytest.mark.parametrize("mode", ["center", "grid"])
+def test_object_centric(mode):
+    cli.main([METHODS[2], WSIS[0], ANNOTATIONS[1], "-ob", mode])
+    remove_result_dir(WSIS[0])
+
+
+def test_sample():
+    results = []
+    for _ in range(2):
+        cli.main([METHODS[1], WSIS[0], ANNOTATIONS[0], "-sp", "3", "-sd", "0"])
+        with open(f"{Path(WSIS[0]).stem}/results.json") as f:
+            results.append(json.load(f)["result"])
+        remove_result_dir(WSIS[0])
+    assert results[0] == results[1]
+    for cls in {patch["class"] for patch in results[0]}:
+        assert sum(patch["class"] == cls for patch in results[0]) <= 3
+
+
+def test_sample_object_centric():
+    with pytest.raises(SystemExit):
+        cli.main([METHODS[2], WSIS[0], ANNOTATIONS[1], "-ob", "center",
+                  "-sp", "3"])
+
+
+@pytest.mark.parametrize("link", ["hardlink", "symlink", "manifest"])
+def test_link(link):
+    cli.main([METHODS[1], WSIS[0], ANNOTATIONS[0], "-ln", link])
+    result_dir = Path(Path(WSIS[0]).stem)
+    assert (result_dir/"store").exists()
+    if link == "manifest":
+        assert (result_dir/"manifest.csv").exists()
+    remove_result_dir(WSIS[0])
+
+
+@pytest.mark.parametrize("encoder", ["pil", "opencv"])
+def test_encoder(encoder):
+    patch = np.full((64, 64, 3), 128, dtype=np.uint8)
+    jpg = wp.encoder(encoder, ext="jpg", quality=90, subsampling="444")
+    assert jpg.encode(patch)[:2] == b"\xff\xd8"
+    webp = wp.encoder(encoder, ext="webp", lossless=True)
+    webp.encode(patch)
+    assert webp.stats()["patches"] == 1
+    cli.main([METHODS[0], WSIS[0], "-en", encoder, "-ex", "png", "-pc", "1"])
+    remove_result_dir(WSIS[0])
+
+
+def test_shards_tar():
+    import pandas as pd
+    from wsiprocess.shard import ShardReader
+    cli.main([METHODS[1], WSIS[0], ANNOTATIONS[0], "-sh", "tar", "-sz", "1"])
+    shards = Path(Path(WSIS[0]).stem)/"shards"
+    index = pd.read_csv(shards/"index.csv")
+    reader = ShardReader(shards)
+    for row in index.itertuples():
+        assert reader.read(row.shard, row.offset, row.size)[:2] == b"\xff\xd8"
+    reader.close()
+    remove_result_dir(WSIS[0])
+
+
+def test_shards_hdf5():
+    pytest.importorskip("h5py")
+    from wsiprocess.shard import get_shard_writer, ShardReader
+    root = Path("shards_hdf5")
+    root.mkdir(exist_ok=True)
+    writer = get_shard_writer("hdf5", root)
+    offsets = [writer.write(str(i), {"bin": bytes([i % 256]) * 10})["bin"]
+               for i in range(300)]
+    writer.flush()
+    writer.close()
+    reader = ShardReader(root)
+    handle = reader.open(offsets[0][0])
+    assert len(handle["data"]) == 300
+    handle.close()
+    for i, (shard, offset, size) in enumerate(offsets):
+        assert reader.read(shard, offset, size) == bytes([i % 256]) * 10
+    reader.close()
+    shutil.rmtree(root)
+
+
+def test_memmap():
+    cli.main([METHODS[1], WSIS[0], ANNOTATIONS[0], "-mp"])
+    memmap = Path(Path(WSIS[0]).stem)/"memmap"
+    patches = np.load(memmap/"patches.npy", mmap_mode="r")
+    with open(memmap/"index.csv") as f:
+        assert len(f.readlines()) == len(patches) + 1
+    assert patches.shape[1:] == (256, 256, 3)
+    remove_result_dir(WSIS[0])
+
+
+def test_result_store():
+    import threading
+    from wsiprocess.result import ResultStore
+    store = ResultStore(["benign", "malignant"], chunk_size=2)
+
+    def add(cls):
+        for x in range(5):
+            store.add(x * 256, 0, 256, 256, classes=[cls])
+            store.add(x * 256, 0, 256, 256, classes=[cls])
+    threads = [threading.Thread(target=add, args=(cls,))
+               for cls in ("benign", "malignant")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(store) == 20
+    records = list(store.records("classification"))
+    assert len(records) == 10
+    assert records[:2] == [
+        {"x": 0, "y": 0, "w": 256, "h": 256, "class": "benign"},
+        {"x": 0, "y": 0, "w": 256, "h": 256, "class": "malignant"}]
+    assert store.class_flags().all()
+
+
+class PlanlessPatcher(wp.patcher):
+    def get_patch(self, x, y, classes):
+        self.save_patch_result(x, y, classes[0])
+
+
+@pytest.mark.parametrize(
+    "worker_type", ["thread", "process", "pipeline", "band", "stream"])
+def test_get_patch_overridden(worker_type):
+    slide = wp.slide(WSIS[0])
+    annotation = wp.annotation(None)
+    annotation.make_masks(slide, foreground_fn="otsu")
+    patcher = PlanlessPatcher(slide, "evaluation", annotation=annotation)
+    patcher.get_patch_parallel(
+        ["foreground"], max_workers=2, worker_type=worker_type)
+    result_dir = Path(Path(WSIS[0]).stem)
+    with open(result_dir/"results.json") as f:
+        assert len(json.load(f)["result"]) == len(patcher.iterator)
+    assert not list((result_dir/"patches").glob("*/*"))
+    remove_result_dir(WSIS[0])
@@ -0,0 +1,65 @@
+# benchmark the order of the patches on the tile cache and the throughput
+#
+#   python utils/benchmark_traversal.py CMU-1.ndpi --workers 8 --cache_tiles 64
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import wsiprocess as wp
+from wsiprocess.grid import CURVES, PatchGrid, traversal_order
+
+
+def benchmark(wsi, curve, patch_size, workers, cache_tiles, limit):
+    probe = wp.slide(wsi)
+    tile_bytes = probe.tile_width * probe.tile_height * 4
+    tile_size = max(probe.tile_width, probe.tile_height)
+    probe.close()
+    slide = wp.slide(
+        wsi, cache_size=cache_tiles*tile_bytes, tile_size=tile_size)
+
+    xs = np.arange(0, slide.width - patch_size + 1, patch_size)
+    ys = np.arange(0, slide.height - patch_size + 1, patch_size)
+    # the default order of the grid, column by column
+    xs, ys = PatchGrid(xs, ys).coords(stop=limit)
+    order = traversal_order(xs, ys, tile_size, tile_size, curve)
+    coords = list(zip(xs[order].tolist(), ys[order].tolist()))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(
+                lambda c: slide.crop(c[0], c[1], patch_size, patch_size),
+                coords):
+            pass
+    elapsed = time.perf_counter() - start
+    stats = slide.cache.stats()
+    slide.close()
+    return len(coords) / elapsed, stats["hit_rate"], stats["misses"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the orders of the patches.")
+    parser.add_argument("wsi", type=str)
+    parser.add_argument("-ps", "--patch_size", type=int, default=256)
+    parser.add_argument("-w", "--workers", type=int, default=8)
+    parser.add_argument(
+        "-ct", "--cache_tiles", type=int, default=64,
+        help="Number of the tiles the tile cache keeps.")
+    parser.add_argument(
+        "-l", "--limit", type=int,
+        help="Use only the first patches of the grid.")
+    args = parser.parse_args()
+
+    print("{:>8} {:>12} {:>9} {:>8}".format(
+        "order", "patches/sec", "hit rate", "decoded"))
+    for curve in CURVES:
+        speed, hit_rate, misses = benchmark(
+            args.wsi, curve, args.patch_size, args.workers, args.cache_tiles,
+            args.limit)
+        print("{:>8} {:>12.1f} {:>9.3f} {:>8}".format(
+            curve, speed, hit_rate, misses))
+
+
+if __name__ == "__main__":
+    main()
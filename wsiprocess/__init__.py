@@ -3,5 +3,6 @@ from .patcher import Patcher as patcher
 from .annotation import Annotation as annotation
 from .rule import Rule as rule
 from .converter import Converter as converter
+from .encoder import get_encoder as encoder
 
 __version__ = "1.1.1"
@@ -23,11 +23,11 @@ import warnings
 from pathlib import Path
 from decimal import Decimal, ROUND_HALF_UP
 
-import psutil
 import cv2
 import numpy as np
 import wsiprocess.annotationparser as parsers
 from .annotationparser.parser_utils import detect_type
+from .mask import Mask
 
 
 class Annotation:
@@ -42,20 +42,30 @@ class Annotation:
             is_image(bool): Whether the image is image.
 
         Attributes:
-            low_memory_consumption (bool): If true, annotaion object does not
-                keep the processed masks on the ram, and read the area from
-                disk when called get_patch.
+            masks (dict): Low resolution masks for each class. Masks are not
+                resized to the size of the slide. Use get_mask() to query them
+                in the coordinates of the slide.
+            mask_store (dict): wsiprocess.mask.Mask objects made from masks.
+            mask_versions (dict): Versions of masks counted up with
+                mask_changed(), to make the Mask objects again after the
+                masks are changed in place.
+            wsi_height (int): Height of the slide the masks are made for.
+            wsi_width (int): Width of the slide the masks are made for.
         """
         self.path = path if path else ""
         self.slide = slide
         self.dot_bbox_width = self.dot_bbox_height = False
         self.is_image = is_image
-        self.low_memory_consumption = False
         self.classes = []
         if not self.is_image:
             self.read_annotation()
         self.masks = {}
+        self.mask_store = {}
+        self.mask_versions = {}
         self.contours = {}
+        self.wsi_height = self.wsi_width = False
+        if slide:
+            self.set_wsi_size(slide.height, slide.width)
 
     def __str__(self):
         return "wsiprocess.annotation.Annotation {}".format(self.path)
@@ -119,9 +129,23 @@ class Annotation:
         for cls in classes:
             self.classes.append(cls)
 
+    def set_wsi_size(self, wsi_height, wsi_width):
+        """Set the size of the slide the masks are mapped onto.
+
+        Args:
+            wsi_height (int): The height of wsi.
+            wsi_width (int): The width of wsi.
+        """
+        if (wsi_height, wsi_width) != (self.wsi_height, self.wsi_width):
+            self.mask_store = {}
+        self.wsi_height = wsi_height
+        self.wsi_width = wsi_width
+
     def from_image(self, mask, cls):
         """Load mask data from an image.
 
+        The mask can be of any size. It is mapped onto the whole slide.
+
         Args:
             mask(numpy.ndarray): 2D mask image with background as 0, and
                 foreground as 255.
@@ -154,7 +178,7 @@ class Annotation:
         if rule:
             self.check_classes(self.classes, rule.classes)
             self.classes = list(set(self.classes) & set(rule.classes))
-        self.check_memory_consumption(slide.height, slide.width)
+        self.set_wsi_size(slide.height, slide.width)
         self.set_scale(size, slide.height, slide.width)
         self.base_masks(size, slide.height, slide.width)
         self.main_masks(size, slide.height, slide.width)
@@ -168,8 +192,6 @@ class Annotation:
             self.merge_include_coords(rule)
             self.exclude_masks(rule)
             # self.exclude_coords(rule)
-        if not self.low_memory_consumption:
-            self.resize_masks(slide.height, slide.width)
 
     def check_classes(self, annotation_class, rule_class):
         if set(annotation_class) != set(rule_class):
@@ -177,16 +199,6 @@ class Annotation:
             msg += f"got annotation: {annotation_class}, rule: {rule_class}"
             warnings.warn(msg)
 
-    def check_memory_consumption(self, wsi_height, wsi_width):
-        num_classes = len(self.classes) if self.classes else 1
-        total_mask_size = num_classes*(wsi_height*wsi_width+120)
-        mask_is_too_large = total_mask_size > psutil.virtual_memory().available
-        if mask_is_too_large:
-            msg = "Full size mask is too large for the RAM. "
-            msg += "Running in low memory consumption mode."
-            warnings.warn(msg)
-            self.low_memory_consumption = True
-
     def set_scale(self, size, wsi_height, wsi_width):
         self.scale = self.get_scale(size, wsi_height, wsi_width)
 
@@ -241,6 +253,8 @@ class Annotation:
                 self.masks[cls],
                 [np.int32(np.array(contour)*scale)], 0, 1,
                 thickness=cv2.FILLED)
+        # drawContours draws on the mask in place
+        self.mask_changed(cls)
 
     def include_masks(self, rule):
         """Merge masks following the rule.
@@ -372,21 +386,6 @@ class Annotation:
         if self.masks["foreground"].shape != (height, width):
             self.masks["foreground"] = cv2.resize(self.masks["foreground"], (width, height))
 
-    def resize_masks(self, wsi_height, wsi_width):
-        """Resize the masks as the same size as the slide
-
-        Args:
-            slide (wsiprocess.slide.Slide): Slide object.
-        """
-        for cls in self.classes:
-            self.resize_mask(wsi_height, wsi_width, cls)
-
-    def resize_mask(self, wsi_height, wsi_width, cls):
-        """Resize a mask as the same size as the slide"""
-
-        self.masks[cls] = cv2.resize(
-            self.masks[cls], (wsi_width, wsi_height))
-
     def _otsu_method_mask(self, thumb_gray):
         """Make mask of foreground with Otsu's method.
 
@@ -464,7 +463,8 @@ class Annotation:
     def export_mask(self, save_to, cls):
         """Export one binary mask image.
 
-        Export mask image with 0 or 1 binaries.
+        Export mask image with 0 or 1 binaries. The mask is exported in the
+        resolution it is kept in.
 
         Args:
             save_to (str): Parent directory to save the thumbnails.
@@ -474,14 +474,67 @@ class Annotation:
             str(Path(save_to)/"{}.png".format(cls)),
             self.masks[cls], (cv2.IMWRITE_PXM_BINARY, 1))
 
+    def mask_changed(self, cls):
+        """Tell that the mask of a class is changed in place.
+
+        get_mask() makes the Mask object again when masks[cls] is replaced,
+        but can not see the changes in place, such as masks[cls][...] = 0 or
+        drawing on it with cv2. Call this after such changes.
+
+        Args:
+            cls (str): Class name of the changed mask.
+        """
+        self.mask_versions[cls] = self.mask_versions.get(cls, 0) + 1
+
+    def get_mask(self, cls):
+        """Get the mask of a class to query in the coordinates of the slide.
+
+        The Mask object is kept until masks[cls] is replaced, or
+        mask_changed() is called for the changes in place.
+
+        Args:
+            cls (str): Class name for each mask.
+
+        Returns:
+            mask (wsiprocess.mask.Mask): Mask object of the class.
+        """
+        mask = self.mask_store.get(cls)
+        version = self.mask_versions.get(cls, 0)
+        if mask is None or mask.source is not self.masks[cls] or \
+                mask.version != version:
+            assert self.wsi_height and self.wsi_width, \
+                "Size of the slide is not set yet."
+            mask = Mask(self.masks[cls], self.wsi_height, self.wsi_width,
+                        version=version)
+            self.mask_store[cls] = mask
+        return mask
+
     def get_patch_mask(self, cls, x, y, w, h):
-        if self.low_memory_consumption:
-            x_ = int(x * self.scale)
-            y_ = int(y * self.scale)
-            w_ = int(w * self.scale)
-            h_ = int(h * self.scale)
-            patch_mask = self.masks[cls][y_:y_+h_, x_:x_+w_]
-            return cv2.resize(patch_mask, dsize=(w, h))
+        """Get the mask of a patch in the resolution of the slide.
 
-        else:
-            return self.masks[cls][y:y+h, x:x+w]
+        Args:
+            cls (str): Class name for each mask.
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            w (int): Width of a patch.
+            h (int): Height of a patch.
+
+        Returns:
+            patch_mask (numpy.ndarray): Binary mask with the shape of (h, w).
+        """
+        return self.get_mask(cls).get_patch_mask(x, y, w, h)
+
+    def coverage(self, cls, x, y, w, h):
+        """Ratio of the area of a patch covered by the mask of a class.
+
+        Args:
+            cls (str): Class name for each mask.
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            w (int): Width of a patch.
+            h (int): Height of a patch.
+
+        Returns:
+            (float): Covered area divided by the area of the patch.
+        """
+        return self.get_mask(cls).coverage(x, y, w, h)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Cache object to keep the decoded tiles of the slide.
+
+Overlapping patches, re-reads of the bounding boxes and sample patches read
+the same area of the slide repeatedly. Tile cache keeps the decoded tiles of
+a fixed size, aligned on each level of the slide, and evicts the least
+recently used tiles when the total size exceeds the budget.
+
+Example:
+    Reading a slide with a tile cache of 256MB:: python
+
+        import wsiprocess as wp
+        slide = wp.slide("CMU-1.ndpi", cache_size=256*1024*1024)
+        patch = slide.crop(1000, 2000, 256, 256)
+        print(slide.cache.stats())
+"""
+from collections import OrderedDict
+import threading
+
+
+class TileCache:
+    """Least recently used cache of the decoded tiles.
+
+    Args:
+        capacity (int): Maximum total bytes of the tiles to keep.
+
+    Attributes:
+        capacity (int): Maximum total bytes of the tiles to keep.
+        size (int): Total bytes of the tiles kept.
+        hits (int): Number of the tiles found in the cache.
+        misses (int): Number of the tiles not found in the cache.
+        evictions (int): Number of the tiles evicted from the cache.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "wsiprocess.cache.TileCache {}/{} bytes".format(
+            self.size, self.capacity)
+
+    def __getstate__(self):
+        # each process keeps its own tiles
+        return {"capacity": self.capacity}
+
+    def __setstate__(self, state):
+        self.__init__(state["capacity"])
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def get(self, key, read_fn):
+        """Get a tile, reading it on a miss.
+
+        Args:
+            key (tuple): Level and tile-aligned coordinates of the tile.
+            read_fn (callable): Function to read the tile as numpy.ndarray.
+
+        Returns:
+            tile (numpy.ndarray): The tile. It must not be modified.
+        """
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+            self.misses += 1
+        # read outside of the lock, not to block the other threads
+        tile = read_fn()
+        self.put(key, tile)
+        return tile
+
+    def put(self, key, tile):
+        """Add a tile and evict the old tiles exceeding the capacity.
+
+        Args:
+            key (tuple): Level and tile-aligned coordinates of the tile.
+            tile (numpy.ndarray): The tile.
+        """
+        if tile.nbytes > self.capacity:
+            return
+        with self.lock:
+            old = self.tiles.pop(key, None)
+            if old is not None:
+                self.size -= old.nbytes
+            self.tiles[key] = tile
+            self.size += tile.nbytes
+            while self.size > self.capacity:
+                _, evicted = self.tiles.popitem(last=False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all the tiles. The counters are kept."""
+        with self.lock:
+            self.tiles.clear()
+            self.size = 0
+
+    def stats(self):
+        """Statistics of the cache.
+
+        Returns:
+            (dict): Hits, misses, hit rate, evictions, tiles and bytes kept.
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 4) if total else 0.,
+                    "evictions": self.evictions,
+                    "tiles": len(self.tiles),
+                    "size": self.size,
+                    "capacity": self.capacity}
@@ -10,7 +10,10 @@ class Args:
         self.build_args(command)
         self.fillattrs(keys=[
             "annotation", "rule", "export_thumbs", "on_annotation", "minmax",
-            "crop_bbox", "extract_foreground"])
+            "crop_bbox", "extract_foreground", "object_centric"])
+        if self.sample and self.object_centric:
+            self.base_parser.error(
+                "--sample is not available with --object_centric")
 
     def set_base_parser(self):
         self.base_parser = argparse.ArgumentParser(
@@ -48,12 +51,82 @@ class Args:
         parser.add_argument(
             "-ex", "--ext", type=str, default="jpg",
             help="Extension of extracted patches")
+        parser.add_argument(
+            "-en", "--encoder", type=str, default="pil",
+            choices=["pil", "opencv"],
+            help="Library to encode the patches.")
+        parser.add_argument(
+            "-qu", "--quality", type=int,
+            help="Quality of jpg and webp patches from 1 to 100.")
+        parser.add_argument(
+            "-su", "--subsampling", type=str, choices=["444", "422", "420"],
+            help="Chroma subsampling of jpg patches.")
+        parser.add_argument(
+            "-pc", "--png_compression", type=int,
+            help="Compression level of png patches from 0 to 9.")
+        parser.add_argument(
+            "-wl", "--webp_lossless", action="store_true",
+            help="Encode webp patches losslessly.")
         parser.add_argument(
             "-ma", "--magnification", type=int,
             help="Magnification of extracted patches")
         parser.add_argument(
             "-mw", "--max_workers", type=int, default=os.cpu_count()//2,
             help="The maximum number of workers to use in patching.")
+        parser.add_argument(
+            "-wt", "--worker_type", type=str, default="thread",
+            choices=["thread", "process", "pipeline", "band", "stream"],
+            help="Run the workers as threads or as processes, or run the "
+                 "threads as a pipeline of read, encode and write stages, or "
+                 "read the rows of patches at once with the threads, or read "
+                 "the slide from the top to the bottom only once.")
+        parser.add_argument(
+            "-be", "--backend", type=str, default="openslide",
+            choices=["openslide", "pyvips"],
+            help="Library to read the slide. The stream worker type reads "
+                 "the slide sequentially only with pyvips.")
+        parser.add_argument(
+            "-rw", "--read_workers", type=int,
+            help="Threads to read patches in the pipeline.")
+        parser.add_argument(
+            "-ew", "--encode_workers", type=int,
+            help="Threads to encode patches in the pipeline.")
+        parser.add_argument(
+            "-ww", "--write_workers", type=int,
+            help="Threads to write patches in the pipeline.")
+        parser.add_argument(
+            "-or", "--order", type=str, default="raster",
+            choices=["raster", "zorder", "hilbert"],
+            help="Order to extract the patches along the tiles of the slide.")
+        parser.add_argument(
+            "-cs", "--cache_size", type=int, default=0,
+            help="Megabytes of the decoded tiles to keep in the tile cache.")
+        parser.add_argument(
+            "-oc", "--openslide_cache_size", type=int,
+            help="Megabytes of the cache of openslide.")
+        parser.add_argument(
+            "-sp", "--sample", type=json.loads,
+            help="Number of the patches to draw at random for each class, "
+                 "ex: 100 or '{\"benign\": 100, \"malignant\": 50}'.")
+        parser.add_argument(
+            "-sd", "--seed", type=int,
+            help="Seed of the random sampling.")
+        parser.add_argument(
+            "-ln", "--link", type=str,
+            choices=["hardlink", "symlink", "manifest"],
+            help="Write a patch on several classes once, and link it to the "
+                 "directories of the classes or list it in manifest.csv.")
+        parser.add_argument(
+            "-sh", "--shards", type=str, choices=["tar", "hdf5", "zarr"],
+            help="Write the patches into shards with an index instead of "
+                 "the files.")
+        parser.add_argument(
+            "-sz", "--shard_size", type=int, default=1024,
+            help="Maximum megabytes of a shard.")
+        parser.add_argument(
+            "-mp", "--memmap", action="store_true",
+            help="Write the patches without encoding into a memory-mapped "
+                 "array instead of the files.")
         parser.add_argument(
             "-ss", "--start_sample", action="store_true",
             help="Generate samples at the start of the process.")
@@ -88,6 +161,10 @@ class Args:
         parser.add_argument(
             "-ef", "--extract_foreground", action="store_true",
             help="If set, wp extracts patches from foreground.")
+        parser.add_argument(
+            "-ob", "--object_centric", type=str, choices=["center", "grid"],
+            help="Extract a patch centered on each annotated object, or the "
+                 "patches of the grid covering the objects.")
         self.add_binarization_method(parser)
         self.add_on_foreground(parser, slide_is_sparse)
         self.add_on_annotation(parser, slide_is_sparse)
@@ -206,9 +283,18 @@ def process_annotation(args, slide, rule):
     return annotation
 
 
+def get_encoder(args):
+    return wp.encoder(
+        args.encoder, ext=args.ext, quality=args.quality,
+        subsampling=args.subsampling, png_compression=args.png_compression,
+        lossless=args.webp_lossless)
+
+
 def main(command=None):
     args = Args(command)
-    slide = wp.slide(args.wsi)
+    slide = wp.slide(
+        args.wsi, backend=args.backend, cache_size=args.cache_size*1024*1024,
+        openslide_cache_size=(args.openslide_cache_size or 0)*1024*1024)
     rule = wp.rule(args.rule) if args.rule else False
     annotation = process_annotation(args, slide, rule)
 
@@ -240,10 +326,23 @@ def main(command=None):
         no_patches=args.no_patches,
         crop_bbox=args.crop_bbox,
         verbose=args.verbose,
-        dryrun=args.dryrun)
+        dryrun=args.dryrun,
+        order=args.order,
+        object_centric=args.object_centric,
+        sample=args.sample,
+        seed=args.seed,
+        link=args.link,
+        encoder=get_encoder(args),
+        shards=args.shards,
+        shard_size=args.shard_size*1024*1024,
+        memmap=args.memmap)
 
     patcher.get_patch_parallel(
-        extract_classes, max_workers=args.max_workers)
+        extract_classes, max_workers=args.max_workers,
+        worker_type=args.worker_type,
+        stage_workers={"read": args.read_workers,
+                       "encode": args.encode_workers,
+                       "write": args.write_workers})
 
     if args.method == "detection":
         converter = wp.converter(
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Encoder objects to encode the patches into image files.
+
+Encoding the patches is one of the largest costs of the CPU when the patches
+are extracted. Encoder objects take a patch as numpy.ndarray or PIL image,
+encode it with PIL or OpenCV with the given parameters, and count the bytes
+and the time spent, to tune the trade-off between the size and the speed.
+
+Example:
+    Encoding patches with OpenCV:: python
+
+        from wsiprocess.encoder import get_encoder
+
+        encoder = get_encoder("opencv", ext="jpg", quality=90,
+                              subsampling="444")
+        data = encoder.encode(patch)
+        print(encoder.stats())
+"""
+import io
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+SUBSAMPLINGS = ("444", "422", "420")
+
+
+class Encoder:
+    """Base class of the encoders.
+
+    Subclasses implement _encode() for numpy.ndarray of RGB or RGBA.
+
+    Args:
+        ext (str): Extension of the encoded images.
+        quality (int, optional): Quality of jpg and webp from 1 to 100. As
+            default, the default of the library.
+        subsampling (str, optional): Chroma subsampling of jpg. One of
+            {"444", "422", "420"}.
+        png_compression (int, optional): Compression level of png from 0 to
+            9.
+        lossless (bool, optional): Encode webp losslessly.
+
+    Attributes:
+        ext (str): Extension of the encoded images.
+        quality (int): Quality of jpg and webp.
+        subsampling (str): Chroma subsampling of jpg.
+        png_compression (int): Compression level of png.
+        lossless (bool): Encode webp losslessly.
+        patches (int): Number of the encoded patches.
+        bytes (int): Total bytes of the encoded patches.
+        seconds (float): Total time spent for the encoding.
+    """
+
+    name = None
+
+    def __init__(self, ext="jpg", quality=None, subsampling=None,
+                 png_compression=None, lossless=False):
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError("quality must be from 1 to 100")
+        if subsampling is not None and subsampling not in SUBSAMPLINGS:
+            raise ValueError(
+                "subsampling={} is not available".format(subsampling))
+        if png_compression is not None and not 0 <= png_compression <= 9:
+            raise ValueError("png_compression must be from 0 to 9")
+        self.ext = ext.lower()
+        self.quality = quality
+        self.subsampling = subsampling
+        self.png_compression = png_compression
+        self.lossless = lossless
+        self.lock = threading.Lock()
+        self.reset()
+
+    def __str__(self):
+        return "wsiprocess.encoder.{} {}".format(
+            self.__class__.__name__, self.ext)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def encode(self, patch):
+        """Encode a patch.
+
+        Args:
+            patch (numpy.ndarray or PIL.Image.Image): Patch of RGB or RGBA.
+
+        Returns:
+            (bytes): Encoded image.
+        """
+        start = time.perf_counter()
+        data = self._encode(patch)
+        elapsed = time.perf_counter() - start
+        self.add(1, len(data), elapsed)
+        return data
+
+    def _encode(self, patch):
+        raise NotImplementedError
+
+    def add(self, patches, size, seconds):
+        """Add to the counters, such as the counts from the other processes.
+
+        Args:
+            patches (int): Number of the encoded patches.
+            size (int): Bytes of the encoded patches.
+            seconds (float): Time spent for the encoding.
+        """
+        with self.lock:
+            self.patches += patches
+            self.bytes += size
+            self.seconds += seconds
+
+    def reset(self):
+        """Reset the counters.
+
+        Returns:
+            (tuple): Number of the patches, the bytes and the seconds counted
+                until the reset.
+        """
+        with self.lock:
+            counts = getattr(self, "patches", 0), getattr(self, "bytes", 0), \
+                getattr(self, "seconds", 0.)
+            self.patches = 0
+            self.bytes = 0
+            self.seconds = 0.
+        return counts
+
+    def stats(self):
+        """Statistics of the encoding.
+
+        Returns:
+            (dict): Patches, total bytes, bytes per patch, total seconds and
+                milliseconds per patch.
+        """
+        with self.lock:
+            n = max(self.patches, 1)
+            return {"encoder": self.name,
+                    "ext": self.ext,
+                    "patches": self.patches,
+                    "bytes": self.bytes,
+                    "bytes_per_patch": round(self.bytes / n, 1),
+                    "seconds": round(self.seconds, 4),
+                    "ms_per_patch": round(1000 * self.seconds / n, 4)}
+
+
+class PILEncoder(Encoder):
+    """Encoder with PIL.Image.save()."""
+
+    name = "pil"
+
+    def _encode(self, patch):
+        if isinstance(patch, np.ndarray):
+            patch = Image.fromarray(patch)
+        params = {}
+        if self.ext in ("jpg", "jpeg"):
+            if self.quality is not None:
+                params["quality"] = self.quality
+            if self.subsampling is not None:
+                params["subsampling"] = SUBSAMPLINGS.index(self.subsampling)
+        elif self.ext == "png":
+            if self.png_compression is not None:
+                params["compress_level"] = self.png_compression
+        elif self.ext == "webp":
+            if self.quality is not None:
+                params["quality"] = self.quality
+            params["lossless"] = self.lossless
+        buffer = io.BytesIO()
+        patch.save(
+            buffer, format=Image.registered_extensions()["." + self.ext],
+            **params)
+        return buffer.getvalue()
+
+
+class OpenCVEncoder(Encoder):
+    """Encoder with cv2.imencode(), which works on numpy.ndarray directly."""
+
+    name = "opencv"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.params = self.make_params()
+
+    def make_params(self):
+        """Parameters of cv2.imencode() for the extension."""
+        params = []
+        if self.ext in ("jpg", "jpeg"):
+            if self.quality is not None:
+                params += [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+            if self.subsampling is not None:
+                if not hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):
+                    raise ValueError(
+                        "subsampling is not available on OpenCV {}".format(
+                            cv2.__version__))
+                params += [
+                    cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+                    getattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR_{}".format(
+                        self.subsampling))]
+        elif self.ext == "png":
+            if self.png_compression is not None:
+                params += [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        elif self.ext == "webp":
+            if self.lossless:
+                # quality above 100 is lossless on OpenCV
+                params += [cv2.IMWRITE_WEBP_QUALITY, 101]
+            elif self.quality is not None:
+                params += [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        return params
+
+    def _encode(self, patch):
+        patch = np.asarray(patch)
+        if patch.ndim == 3 and patch.shape[2] == 4:
+            patch = cv2.cvtColor(patch, cv2.COLOR_RGBA2BGRA)
+        elif patch.ndim == 3:
+            patch = cv2.cvtColor(patch, cv2.COLOR_RGB2BGR)
+        success, data = cv2.imencode("." + self.ext, patch, self.params)
+        if not success:
+            raise ValueError("failed to encode a patch as {}".format(self.ext))
+        return data.tobytes()
+
+
+ENCODERS = {"pil": PILEncoder, "opencv": OpenCVEncoder}
+
+
+def get_encoder(name="pil", **kwargs):
+    """Make an encoder.
+
+    Args:
+        name (str): One of {"pil", "opencv"}.
+        **kwargs: Arguments of wsiprocess.encoder.Encoder.
+
+    Returns:
+        (wsiprocess.encoder.Encoder): The encoder.
+    """
+    if name not in ENCODERS:
+        raise NotImplementedError("encoder={} is not available".format(name))
+    return ENCODERS[name](**kwargs)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Grid object to hold the offsets of the patches.
+
+The offsets of the patches are the product of the offsets along the x-axis
+and the y-axis. Grid object keeps only the two axes as arrays and computes
+the offsets of the patches from their indices on demand, so that the memory
+does not grow with the number of the patches.
+
+Example:
+    Iterating over the offsets in chunks:: python
+
+        from wsiprocess.grid import PatchGrid
+
+        grid = PatchGrid(xs=[0, 256, 512], ys=[0, 256])
+        for xs, ys in grid.chunks(1024):
+            print(xs, ys)
+"""
+import cv2
+import numpy as np
+
+
+CURVES = ("raster", "zorder", "hilbert")
+
+
+class PatchGrid:
+    """Offsets of the patches on a grid.
+
+    The patches are ordered column by column, the same as
+    itertools.product(xs, ys).
+
+    Args:
+        xs (array_like): Offsets of the patches along the x-axis.
+        ys (array_like): Offsets of the patches along the y-axis.
+        limit (int, optional): Use only the first patches up to this number.
+
+    Attributes:
+        xs (numpy.ndarray): Offsets of the patches along the x-axis.
+        ys (numpy.ndarray): Offsets of the patches along the y-axis.
+    """
+
+    def __init__(self, xs, ys, limit=None):
+        self.xs = np.asarray(xs, dtype=np.int32)
+        self.ys = np.asarray(ys, dtype=np.int32)
+        self.limit = limit
+
+    def __str__(self):
+        return "wsiprocess.grid.PatchGrid {}x{}".format(
+            len(self.xs), len(self.ys))
+
+    def __len__(self):
+        total = len(self.xs) * len(self.ys)
+        if self.limit is not None:
+            return min(total, self.limit)
+        return total
+
+    def __iter__(self):
+        for xs, ys in self.chunks():
+            yield from zip(xs.tolist(), ys.tolist())
+
+    def coords(self, start=0, stop=None):
+        """Offsets of the patches in a range of indices.
+
+        Args:
+            start (int): The first index.
+            stop (int, optional): The index to stop before. As default, the
+                end of the grid.
+
+        Returns:
+            xs (numpy.ndarray): X-axis offsets of the patches.
+            ys (numpy.ndarray): Y-axis offsets of the patches.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        indices = np.arange(start, stop, dtype=np.int64)
+        return self.coords_at(indices)
+
+    def coords_at(self, indices):
+        """Offsets of the patches at the indices.
+
+        Args:
+            indices (numpy.ndarray): Indices of the patches.
+
+        Returns:
+            xs (numpy.ndarray): X-axis offsets of the patches.
+            ys (numpy.ndarray): Y-axis offsets of the patches.
+        """
+        col, row = np.divmod(indices, len(self.ys))
+        return self.xs[col].astype(np.int64), self.ys[row].astype(np.int64)
+
+    def chunks(self, size=65536):
+        """Iterate over the offsets of the patches in chunks.
+
+        Args:
+            size (int): Number of the patches in a chunk.
+
+        Yields:
+            (tuple): X-axis offsets and Y-axis offsets of the patches.
+        """
+        for start in range(0, len(self), size):
+            yield self.coords(start, start + size)
+
+    def head(self, n):
+        """Grid with the first n patches only.
+
+        Args:
+            n (int): Number of the patches.
+
+        Returns:
+            (wsiprocess.grid.PatchGrid): The limited grid.
+        """
+        if self.limit is not None:
+            n = min(n, self.limit)
+        return PatchGrid(self.xs, self.ys, limit=n)
+
+    def cells(self, boxes, width, height):
+        """Cells of the grid whose patches overlap the boxes.
+
+        Args:
+            boxes (array_like): Left, top, right and bottom of the boxes on
+                the level 0, with the shape of (N, 4).
+            width (int): Width of a patch.
+            height (int): Height of a patch.
+
+        Returns:
+            cells (numpy.ndarray): Boolean matrix with the shape of
+                (len(xs), len(ys)).
+        """
+        cells = np.zeros((len(self.xs), len(self.ys)), dtype=bool)
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        x0 = np.searchsorted(self.xs, boxes[:, 0] - width, side="right")
+        x1 = np.searchsorted(self.xs, boxes[:, 2], side="left")
+        y0 = np.searchsorted(self.ys, boxes[:, 1] - height, side="right")
+        y1 = np.searchsorted(self.ys, boxes[:, 3], side="left")
+        for left, right, top, bottom in zip(x0, x1, y0, y1):
+            cells[left:right, top:bottom] = True
+        return cells
+
+    def regions(self, cells):
+        """Split the cells into the regions of connected cells.
+
+        Args:
+            cells (numpy.ndarray): Boolean matrix from cells().
+
+        Returns:
+            regions (list): wsiprocess.grid.PatchRegion objects.
+        """
+        if self.limit is not None:
+            cells = cells.copy()
+            cells.reshape(-1)[self.limit:] = False
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(
+            cells.astype(np.uint8), connectivity=8)
+        regions = []
+        for label in range(1, n):
+            # stats are given along the axes of the image, rows are xs here
+            top, left, height, width = stats[label, :4]
+            block = labels[left:left + width, top:top + height] == label
+            regions.append(PatchRegion(
+                self.xs[left:left + width], self.ys[top:top + height], block))
+        return regions
+
+
+class PatchRegion:
+    """Connected cells of the grid, which can be planned independently of the
+    other regions.
+
+    Args:
+        xs (array_like): Offsets of the columns of the region.
+        ys (array_like): Offsets of the rows of the region.
+        cells (numpy.ndarray): Boolean matrix of the cells in the region with
+            the shape of (len(xs), len(ys)).
+
+    Attributes:
+        xs (numpy.ndarray): Offsets of the columns of the region.
+        ys (numpy.ndarray): Offsets of the rows of the region.
+        cells (numpy.ndarray): Boolean matrix of the cells in the region.
+    """
+
+    def __init__(self, xs, ys, cells):
+        self.xs = np.asarray(xs, dtype=np.int32)
+        self.ys = np.asarray(ys, dtype=np.int32)
+        self.cells = cells
+
+    def __str__(self):
+        return "wsiprocess.grid.PatchRegion {} patches at ({}, {})".format(
+            len(self), self.xs[0], self.ys[0])
+
+    def __len__(self):
+        return int(self.cells.sum())
+
+    def coords(self):
+        """Offsets of the patches in the region, in the order of the grid.
+
+        Returns:
+            xs (numpy.ndarray): X-axis offsets of the patches.
+            ys (numpy.ndarray): Y-axis offsets of the patches.
+        """
+        col, row = np.nonzero(self.cells)
+        return self.xs[col].astype(np.int64), self.ys[row].astype(np.int64)
+
+    def chunks(self, size=65536):
+        """Iterate over the offsets of the patches in chunks.
+
+        Args:
+            size (int): Number of the patches in a chunk.
+
+        Yields:
+            (tuple): X-axis offsets and Y-axis offsets of the patches.
+        """
+        xs, ys = self.coords()
+        for start in range(0, len(xs), size):
+            yield xs[start:start + size], ys[start:start + size]
+
+
+def traversal_order(xs, ys, chunk_width, chunk_height, curve="zorder"):
+    """Order of the patches to visit the neighbouring tiles in succession.
+
+    The slide is divided into chunks of the given size, usually the size of
+    the tiles of the slide, and the chunks are visited along a space-filling
+    curve. The patches in a chunk are visited row by row.
+
+    Args:
+        xs (numpy.ndarray): X-axis offsets of the patches.
+        ys (numpy.ndarray): Y-axis offsets of the patches.
+        chunk_width (int): Width of the chunks.
+        chunk_height (int): Height of the chunks.
+        curve (str): One of {"raster", "zorder", "hilbert"}. Raster keeps the
+            order as it is.
+
+    Returns:
+        (numpy.ndarray): Indices of the patches in the order to visit.
+    """
+    if curve not in CURVES:
+        raise NotImplementedError("curve={} is not available".format(curve))
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    if curve == "raster" or len(xs) == 0:
+        return np.arange(len(xs))
+    cx = np.maximum(xs, 0) // chunk_width
+    cy = np.maximum(ys, 0) // chunk_height
+    if curve == "zorder":
+        key = zorder_index(cx, cy)
+    else:
+        bits = max(int(max(cx.max(), cy.max())).bit_length(), 1)
+        key = hilbert_index(cx, cy, bits)
+    return np.lexsort((xs, ys, key))
+
+
+def _spread_bits(v):
+    """Insert a 0 bit between each bit of 32 bit integers."""
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF),
+                        (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def zorder_index(x, y):
+    """Index on the Z-order (Morton) curve.
+
+    Args:
+        x (numpy.ndarray): Non-negative X-axis coordinates.
+        y (numpy.ndarray): Non-negative Y-axis coordinates.
+
+    Returns:
+        (numpy.ndarray): Indices on the curve.
+    """
+    return _spread_bits(x) | (_spread_bits(y) << np.uint64(1))
+
+
+def hilbert_index(x, y, bits):
+    """Index on the Hilbert curve filling a square of 2**bits.
+
+    Args:
+        x (numpy.ndarray): Non-negative X-axis coordinates.
+        y (numpy.ndarray): Non-negative Y-axis coordinates.
+        bits (int): Number of bits of the coordinates.
+
+    Returns:
+        (numpy.ndarray): Indices on the curve.
+    """
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    n = 1 << bits
+    index = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        index += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return index
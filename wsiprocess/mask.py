@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""Mask object to answer queries on a low resolution mask.
+
+Masks are made on a thumbnail of the slide, which is much smaller than the
+slide itself. Mask object keeps the low resolution raster as it is, and
+answers the queries given in the coordinates of the level 0 of the slide,
+so that the memory consumption depends on the size of the mask, not on the
+size of the slide.
+
+Example:
+    Querying the coverage of a patch:: python
+
+        import wsiprocess as wp
+        slide = wp.slide("CMU-1.ndpi")
+        annotation = wp.annotation("CMU-1_classification.xml")
+        annotation.make_masks(slide)
+        mask = annotation.get_mask("benign")
+        ratio = mask.coverage(x=1000, y=2000, w=256, h=256)
+"""
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+
+class Mask:
+    """Low resolution mask with the geometry of the slide.
+
+    Each pixel of the mask is regarded as a rectangle on the level 0 of the
+    slide, so the scaling between the mask and the slide is exact along both
+    axes. An integral image (summed-area table) of the mask is kept to answer
+    the covered area of any rectangle with four lookups.
+
+    Args:
+        mask (numpy.ndarray): 2D mask image. Non-zero pixels are foreground.
+        wsi_height (int): Height of the slide.
+        wsi_width (int): Width of the slide.
+        integral (numpy.ndarray, optional): Integral image of the mask if it
+            is already computed.
+        version (int, optional): Version of the source given by its owner,
+            to tell whether the source is changed since.
+
+    Attributes:
+        source (numpy.ndarray): The mask given on initialization.
+        version (int): Version of the source.
+        mask (numpy.ndarray): Binary mask with foreground as 1.
+        integral (numpy.ndarray): Integral image of the mask with the shape of
+            (height + 1, width + 1).
+        height (int): Height of the mask.
+        width (int): Width of the mask.
+        wsi_height (int): Height of the slide.
+        wsi_width (int): Width of the slide.
+        scale_x (float): Ratio of the width of the mask to the slide.
+        scale_y (float): Ratio of the height of the mask to the slide.
+    """
+
+    def __init__(self, mask, wsi_height, wsi_width, integral=None,
+                 version=0):
+        assert len(mask.shape) == 2, "Mask image is not 2D."
+        self.source = mask
+        self.version = version
+        if mask.dtype != np.uint8 or mask.max() > 1:
+            mask = (mask > 0).astype(np.uint8)
+        self.mask = mask
+        if integral is None:
+            integral = cv2.integral(mask, sdepth=cv2.CV_32S)
+        self.integral = integral
+        self.height, self.width = mask.shape
+        self.wsi_height = wsi_height
+        self.wsi_width = wsi_width
+        self.scale_x = self.width / wsi_width
+        self.scale_y = self.height / wsi_height
+        self.components = None
+
+    def __str__(self):
+        return "wsiprocess.mask.Mask {}x{} for {}x{}".format(
+            self.width, self.height, self.wsi_width, self.wsi_height)
+
+    def get_patch_mask(self, x, y, w, h):
+        """Get the mask of a patch in the resolution of the level 0.
+
+        Each pixel of the patch takes the value of the mask pixel its center
+        falls on. Pixels outside of the slide are 0.
+
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            w (int): Width of a patch.
+            h (int): Height of a patch.
+
+        Returns:
+            patch_mask (numpy.ndarray): Binary mask with the shape of (h, w).
+        """
+        xs = self._sample_indices(x, w, self.scale_x)
+        ys = self._sample_indices(y, h, self.scale_y)
+        patch_mask = np.zeros((h, w), dtype=np.uint8)
+        x_valid = np.flatnonzero((0 <= xs) & (xs < self.width))
+        y_valid = np.flatnonzero((0 <= ys) & (ys < self.height))
+        if x_valid.size == 0 or y_valid.size == 0:
+            return patch_mask
+        x0, x1 = x_valid[0], x_valid[-1] + 1
+        y0, y1 = y_valid[0], y_valid[-1] + 1
+        patch_mask[y0:y1, x0:x1] = self.mask[np.ix_(ys[y0:y1], xs[x0:x1])]
+        return patch_mask
+
+    def coverage(self, x, y, w, h):
+        """Ratio of the area of a patch covered by the mask.
+
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            w (int): Width of a patch.
+            h (int): Height of a patch.
+
+        Returns:
+            (float): Covered area divided by the area of the patch, rounded
+                to remove the rounding errors of the integral.
+        """
+        return np.round(self.area(x, y, w, h) / (w * h), 9)
+
+    def area(self, x, y, w, h):
+        """Area of a patch covered by the mask in the resolution of level 0.
+
+        The computation costs O(1) regardless of the size of the patch.
+
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            w (int): Width of a patch.
+            h (int): Height of a patch.
+
+        Returns:
+            (float): Covered area in pixels of the level 0.
+        """
+        left = np.clip(x * self.scale_x, 0, self.width)
+        right = np.clip((x + w) * self.scale_x, 0, self.width)
+        top = np.clip(y * self.scale_y, 0, self.height)
+        bottom = np.clip((y + h) * self.scale_y, 0, self.height)
+        covered = self._integral_at(right, bottom) \
+            - self._integral_at(left, bottom) \
+            - self._integral_at(right, top) \
+            + self._integral_at(left, top)
+        return covered / (self.scale_x * self.scale_y)
+
+    def sample_points(self, rng, n):
+        """Draw points uniformly from the foreground of the mask.
+
+        A pixel of the mask is drawn with the inverse of the cumulative sums
+        in the integral image, so the cost depends on the number of the
+        points and the width of the mask, not on the area.
+
+        Args:
+            rng (numpy.random.Generator): Random number generator.
+            n (int): Number of the points.
+
+        Returns:
+            xs (numpy.ndarray): X-axis coordinates of the points on the level 0.
+            ys (numpy.ndarray): Y-axis coordinates of the points on the level 0.
+        """
+        rows_cumsum = self.integral[1:, -1]
+        total = int(rows_cumsum[-1]) if len(rows_cumsum) else 0
+        if total == 0 or n == 0:
+            return np.zeros(0), np.zeros(0)
+        nth = rng.integers(total, size=n)
+        rows = np.searchsorted(rows_cumsum, nth, side="right")
+        nth -= np.where(rows > 0, rows_cumsum[rows - 1], 0)
+        cols = np.empty(n, dtype=np.int64)
+        for i, (row, k) in enumerate(zip(rows, nth)):
+            row_cumsum = self.integral[row + 1, 1:] - self.integral[row, 1:]
+            cols[i] = np.searchsorted(row_cumsum, k, side="right")
+        xs = (cols + rng.random(n)) / self.scale_x
+        ys = (rows + rng.random(n)) / self.scale_y
+        return xs, ys
+
+    def bounding_boxes(self, pad=1):
+        """Bounding boxes of the connected components of the mask.
+
+        Args:
+            pad (int): Pixels of the mask to pad the boxes with.
+
+        Returns:
+            boxes (numpy.ndarray): Left, top, right and bottom of the boxes on
+                the level 0, with the shape of (N, 4).
+        """
+        if self.components is None:
+            # outer contours have the same boxes as the components
+            contours, _ = cv2.findContours(
+                self.mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            self.components = np.array(
+                [cv2.boundingRect(c) for c in contours],
+                dtype=np.float64).reshape(-1, 4)
+        left, top, width, height = self.components.T
+        return np.stack([
+            (left - pad) / self.scale_x,
+            (top - pad) / self.scale_y,
+            (left + width + pad) / self.scale_x,
+            (top + height + pad) / self.scale_y], axis=1)
+
+    def _integral_at(self, u, v):
+        """Covered area of [0, u) x [0, v) in the resolution of the mask.
+
+        As the mask is constant in each pixel, the integral at fractional
+        coordinates is the bilinear interpolation of the integral image.
+        """
+        i = np.minimum(np.floor(u).astype(np.int64), self.width - 1)
+        j = np.minimum(np.floor(v).astype(np.int64), self.height - 1)
+        s = u - i
+        t = v - j
+        integral = self.integral
+        return integral[j, i] * (1 - s) * (1 - t) \
+            + integral[j, i + 1] * s * (1 - t) \
+            + integral[j + 1, i] * (1 - s) * t \
+            + integral[j + 1, i + 1] * s * t
+
+    @staticmethod
+    def _sample_indices(start, length, scale):
+        """Indices of mask pixels on which the level 0 pixels fall."""
+        centers = np.arange(start, start + length) + 0.5
+        return np.floor(centers * scale).astype(np.int64)
+
+
+class SharedMasks:
+    """Masks placed on the shared memory for worker processes.
+
+    The masks and their integral images are copied to the shared memory once,
+    and only the names of the memory blocks are pickled when SharedMasks is
+    sent to the worker processes.
+
+    Args:
+        masks (dict): wsiprocess.mask.Mask objects for each class.
+
+    Attributes:
+        specs (dict): Names, shapes and dtypes of the shared arrays for each
+            class.
+    """
+
+    def __init__(self, masks):
+        self.specs = {}
+        self.blocks = []
+        for cls, mask in masks.items():
+            self.specs[cls] = {
+                "mask": self._share(mask.mask),
+                "integral": self._share(mask.integral),
+                "wsi_height": mask.wsi_height,
+                "wsi_width": mask.wsi_width,
+                "version": mask.version}
+
+    def __getstate__(self):
+        return {"specs": self.specs, "blocks": []}
+
+    def _share(self, array):
+        block = shared_memory.SharedMemory(
+            create=True, size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[:] = array
+        self.blocks.append(block)
+        return block.name, array.shape, array.dtype.str
+
+    def _attach(self, spec):
+        name, shape, dtype = spec
+        try:
+            block = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # python < 3.13 always tracks the block, but the tracker is shared
+            # with the parent process, which unlinks the block.
+            block = shared_memory.SharedMemory(name=name)
+        self.blocks.append(block)
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def attach(self):
+        """Get the masks on the shared memory in the worker processes.
+
+        Returns:
+            masks (dict): wsiprocess.mask.Mask objects for each class.
+        """
+        masks = {}
+        for cls, spec in self.specs.items():
+            masks[cls] = Mask(
+                self._attach(spec["mask"]), spec["wsi_height"],
+                spec["wsi_width"], integral=self._attach(spec["integral"]),
+                version=spec["version"])
+        return masks
+
+    def close(self, unlink=False):
+        """Release the shared memory.
+
+        Args:
+            unlink (bool): Whether to free the memory blocks. Only the process
+                which made SharedMasks should unlink them.
+        """
+        for block in self.blocks:
+            block.close()
+            if unlink:
+                block.unlink()
+        self.blocks = []
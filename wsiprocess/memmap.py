@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Memory-mapped array to keep the decoded patches of a slide.
+
+Decoding JPEG files can take more CPU than the model when small patches are
+read over many epochs. PatchMemmap writes the patches as they are, in uint8,
+into an array of (N, H, W, 3) preallocated on the disk in the format of
+.npy, with index.csv of the rows. The patches are read back as views of the
+page cache without decoding or copying.
+
+Example:
+    Reading the patches:: python
+
+        import numpy as np
+        import pandas as pd
+
+        patches = np.load("CMU-1/memmap/patches.npy", mmap_mode="r")
+        index = pd.read_csv("CMU-1/memmap/index.csv")
+        patch = patches[index.loc[0, "row"]]
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+class PatchMemmap:
+    """Memory-mapped array of the patches of a slide.
+
+    The rows of the array are the patches in the order of the plan, so that
+    each worker finds the row of a patch from its offsets.
+
+    Args:
+        root (str): Directory to save patches.npy and index.csv.
+
+    Attributes:
+        root (pathlib.Path): Directory to save patches.npy and index.csv.
+        path (pathlib.Path): Path to patches.npy.
+        shape (tuple): Shape of the array.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.path = self.root/"patches.npy"
+        self.shape = None
+        self.keys = None
+        self.rows = None
+        self.array = None
+
+    def __str__(self):
+        return "wsiprocess.memmap.PatchMemmap {} {}".format(
+            self.path, self.shape)
+
+    def __getstate__(self):
+        # each process maps the file by itself
+        state = self.__dict__.copy()
+        state["array"] = None
+        return state
+
+    @staticmethod
+    def pack(xs, ys):
+        """Pack the offsets into integer keys."""
+        return (np.asarray(xs, dtype=np.int64) << 32) | \
+            np.asarray(ys, dtype=np.int64)
+
+    def create(self, xs, ys, on_classes, plan_classes, width, height):
+        """Allocate the array and save the index for the planned patches.
+
+        Args:
+            xs (numpy.ndarray): X-axis offsets of the planned patches.
+            ys (numpy.ndarray): Y-axis offsets of the planned patches.
+            on_classes (numpy.ndarray): Boolean matrix of the patches on each
+                of plan_classes.
+            plan_classes (list): Classes of the columns of on_classes.
+            width (int): Width of the output patches.
+            height (int): Height of the output patches.
+        """
+        keys = self.pack(xs, ys)
+        self.rows = np.argsort(keys, kind="stable")
+        self.keys = keys[self.rows]
+        self.shape = (len(keys), height, width, 3)
+        self.array = np.lib.format.open_memmap(
+            self.path, mode="w+", dtype=np.uint8, shape=self.shape)
+        index = pd.DataFrame({"row": np.arange(len(keys)), "x": xs, "y": ys})
+        for i, cls in enumerate(plan_classes):
+            index[cls] = on_classes[:, i]
+        index.to_csv(self.root/"index.csv", index=None)
+
+    def row(self, x, y):
+        """Row of a patch.
+
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+
+        Returns:
+            (int): Row of the patch in the array.
+        """
+        key = self.pack(x, y)
+        i = int(np.searchsorted(self.keys, key))
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError("patch at ({}, {}) is not planned".format(x, y))
+        return int(self.rows[i])
+
+    def write(self, x, y, patch):
+        """Write a patch into its row.
+
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            patch (numpy.ndarray or PIL.Image.Image): Patch of RGB or RGBA
+                with the output size.
+        """
+        patch = np.asarray(patch)
+        if patch.ndim == 3 and patch.shape[2] == 4:
+            patch = patch[..., :3]
+        if patch.shape != self.shape[1:]:
+            raise ValueError("patch of {} does not fit the array of {}".format(
+                patch.shape, self.shape))
+        if self.array is None:
+            self.array = np.load(self.path, mmap_mode="r+")
+        self.array[self.row(x, y)] = patch
+
+    def close(self):
+        """Flush the array to the disk. It is mapped again on the next
+        write."""
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
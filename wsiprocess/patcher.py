@@ -4,10 +4,14 @@
 
 import warnings
 import random
-from itertools import product
+from itertools import islice
 import json
 import os
-from concurrent.futures import ThreadPoolExecutor
+import copy
+import hashlib
+import threading
+import multiprocessing.util
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from tqdm import tqdm
 import numpy as np
@@ -16,6 +20,18 @@ from pathlib import Path
 import pandas as pd
 
 from .verify import Verify
+from .mask import SharedMasks
+from .pipeline import Pipeline, bounded_map
+from .grid import PatchGrid, PatchRegion, traversal_order
+from .spatial import BoxIndex, pack_boxes
+from .encoder import PILEncoder
+from .shard import get_shard_writer
+from .memmap import PatchMemmap
+from .result import ResultStore
+
+
+# coverages closer to the thresholds than this are checked patch by patch
+_MARGIN = 1e-6
 
 
 class Patcher:
@@ -53,6 +69,39 @@ class Patcher:
             patches and saves them to disk.
         verbose (bool, optional): If set, a progress bar appears when patching.
         dryrun (bool, optional): Only run patching for first 100 patches.
+        order (str, optional): Order to extract the patches. One of
+            {"raster", "zorder", "hilbert"}. Zorder and hilbert visit the
+            tiles of the slide along the curve, so that the workers running
+            at the same time read the neighbouring tiles.
+        rois (list, optional): Regions of interest as [x, y, width, height]
+            on the level 0. Only the patches overlapping them are extracted.
+        object_centric (str, optional): Extract the patches around the
+            annotated objects instead of scanning the grid. "center" extracts
+            a patch centered on each object, and "grid" extracts the patches
+            of the grid covering the objects. Objects inside a patch already
+            extracted do not make another patch.
+        sample (int or dict, optional): Number of the patches to draw at
+            random for each class instead of extracting all of them. dict is
+            also available ex: {"label": value}. Not available with
+            object_centric.
+        seed (int, optional): Seed of the random sampling.
+        link (str, optional): How to store a patch on several classes. One of
+            {"hardlink", "symlink", "manifest"}. The patch is written once
+            in the store directory named by the hash of its content, and the
+            directories of the classes get hard links or symbolic links to
+            it, or nothing but the rows of manifest.csv. As default, a copy
+            of the patch is written for each class.
+        encoder (wsiprocess.encoder.Encoder, optional): Encoder of the
+            patches, with the same extension as ext. As default, PIL with
+            its default parameters.
+        shards (str, optional): Write the patches and the masks into shards
+            instead of the files. One of {"tar", "hdf5", "zarr"}. The
+            shards and index.csv to find the patches in them are saved in
+            the "shards" directory. link is not used with the shards.
+        shard_size (int, optional): Maximum bytes of a shard.
+        memmap (bool, optional): Write the patches without encoding into an
+            array of (N, H, W, 3) mapped on "memmap/patches.npy", with
+            "memmap/index.csv" of the rows, instead of the files.
 
     Attributes:
         slide (wsiprocess.slide.Slide): Slide object.
@@ -90,16 +139,29 @@ class Patcher:
         no_patches (bool): Whether to save patches when Patcher runs.
         verbose (bool, optional): If set, a progress bar appears when patching.
         dryrun (bool, optional): Only run patching for first 100 patches.
-
-        x_lefttop (list): Offsets of patches to the x-axis direction except for
-            the right edge.
-        y_lefttop (list): Offsets of patches to the y-axis direction except for
-            the bottom edge.
-        iterator (list):  Offset coordinates of patches.
+        order (str): Order to extract the patches.
+        rois (numpy.ndarray): Regions of interest as [x, y, width, height].
+        object_centric (str): Extract the patches around the objects.
+        sample (int or dict): Number of the patches to draw for each class.
+        seed (int): Seed of the random sampling.
+        link (str): How to store a patch on several classes.
+        manifest (list): Classes and paths of the patches in the store, when
+            link is "manifest".
+        encoder (wsiprocess.encoder.Encoder): Encoder of the patches.
+        shards (wsiprocess.shard.ShardWriter): Writer of the shards.
+        shard_index (list): Shards and offsets of the patches and the masks.
+        memmap (wsiprocess.memmap.PatchMemmap): Array of the patches.
+
+        x_lefttop (numpy.ndarray): Offsets of patches to the x-axis direction
+            except for the right edge.
+        y_lefttop (numpy.ndarray): Offsets of patches to the y-axis direction
+            except for the bottom edge.
+        iterator (wsiprocess.grid.PatchGrid):  Offset coordinates of patches.
         last_x (int): X-axis offset of the right edge patch.
         last_y (int): Y-axis offset of the right edge patch.
 
-        result (dict): Temporary storage for the computed result of patches.
+        results (wsiprocess.result.ResultStore): Temporary storage for the
+            computed result of patches.
     """
 
     def __init__(
@@ -108,7 +170,10 @@ class Patcher:
             overlap_height=0, offset_x=0, offset_y=0, on_foreground=0.5,
             on_annotation=0.5, ext="jpg", magnification=False,
             start_sample=False, finished_sample=False, no_patches=False,
-            crop_bbox=False, verbose=False, dryrun=False):
+            crop_bbox=False, verbose=False, dryrun=False, order="raster",
+            rois=None, object_centric=False, sample=False, seed=None,
+            link=False, encoder=None, shards=None, shard_size=1 << 30,
+            memmap=False):
         self.verify = Verify(
             save_to, slide.filestem, method, start_sample, finished_sample,
             no_patches, crop_bbox)
@@ -135,22 +200,56 @@ class Patcher:
         self.offset_y = int(offset_y)
         self.dot_bbox_width = annotation.dot_bbox_width
         self.dot_bbox_height = annotation.dot_bbox_height
-        self.x_lefttop = [i for i in range(
+        self.x_lefttop = np.arange(
             self.offset_x,
             self.wsi_width,
-            patch_width - overlap_width)][:-1]
-        self.y_lefttop = [i for i in range(
+            patch_width - overlap_width)[:-1]
+        self.y_lefttop = np.arange(
             self.offset_y,
             self.wsi_height,
-            patch_height - overlap_height)][:-1]
+            patch_height - overlap_height)[:-1]
 
         self.last_x = self.slide.width - patch_width
         self.last_y = self.slide.height - patch_height
 
         self.dryrun = dryrun
         self.get_iterator(dryrun)
+        self.order = order
+        self.rois = None if rois is None else \
+            np.asarray(rois, dtype=np.float64).reshape(-1, 4)
+        if object_centric not in (False, None, "center", "grid"):
+            raise NotImplementedError(
+                "object_centric={} is not available".format(object_centric))
+        self.object_centric = object_centric
+        if sample and object_centric:
+            raise ValueError(
+                "sample is not available with object_centric={}".format(
+                    object_centric))
+        self.sample = sample
+        self.seed = seed
+        if link not in (False, None, "hardlink", "symlink", "manifest"):
+            raise NotImplementedError(
+                "link={} is not available".format(link))
+        self.link = link
 
         self.ext = ext
+        if encoder is None:
+            encoder = PILEncoder(ext)
+        elif encoder.ext != ext.lower():
+            raise ValueError("ext={} differs from the encoder {}".format(
+                ext, encoder))
+        self.encoder = encoder
+        if shards:
+            self.shards = get_shard_writer(
+                shards, "{}/{}/shards".format(save_to, slide.filestem),
+                prefix=slide.filestem.replace(".", "_"), max_size=shard_size)
+        else:
+            self.shards = None
+        if memmap:
+            self.memmap = PatchMemmap(
+                "{}/{}/memmap".format(save_to, slide.filestem))
+        else:
+            self.memmap = None
 
         self.start_sample = start_sample
         self.finished_sample = finished_sample
@@ -161,6 +260,7 @@ class Patcher:
         self.on_foreground = on_foreground
         self.annotation = annotation
         if annotation:
+            annotation.set_wsi_size(self.wsi_height, self.wsi_width)
             self.masks = annotation.masks
             self.classes = annotation.classes
             if isinstance(on_annotation, (float, int)):
@@ -175,22 +275,32 @@ class Patcher:
 
         self.save_to = save_to
 
-        self.result = {"result": []}
+        result_classes = list(self.classes)
+        if "foreground" not in result_classes:
+            result_classes.append("foreground")
+        self.results = ResultStore(result_classes)
+        self.manifest = []
+        self.shard_index = []
+        self.bb_indices = {}
 
     def __str__(self):
         return "wsiprocess.patcher.Patcher {}".format(self.slide.path)
 
     def get_iterator(self, dryrun=False):
-        self.iterator = list(product(self.x_lefttop, self.y_lefttop))
-        bottomedge = [(x, self.last_y) for x in self.x_lefttop]
-        rightedge = [(self.last_x, y) for y in self.y_lefttop]
-        rightbottom = [(self.last_x, self.last_y)]
-        self.iterator += bottomedge
-        self.iterator += rightedge
-        self.iterator += rightbottom
+        """Set the grid of the offsets of patches.
+
+        The patches on the right edge and the bottom edge are aligned to the
+        edges of the slide.
+
+        Args:
+            dryrun (bool): Use only the first 100 patches.
+        """
+        xs = np.unique(np.append(self.x_lefttop, self.last_x))
+        ys = np.unique(np.append(self.y_lefttop, self.last_y))
+        self.iterator = PatchGrid(xs, ys)
 
         if dryrun:
-            self.iterator = self.iterator[:100]
+            self.iterator = self.iterator.head(100)
 
     def set_magnification(self, slide, magnification):
         self.magnification = magnification
@@ -207,7 +317,7 @@ class Patcher:
         else:
             self.p_scale = 1
 
-    def save_patch_result(self, x, y, cls):
+    def save_patch_result(self, x, y, cls, shard_masks=None):
         """Save the extracted patch data to result
 
         Args:
@@ -215,47 +325,31 @@ class Patcher:
             y (int): Y-axis offset of patch.
             cls (str): Class of the patch or the bounding box or the segmented
                 area.
+            shard_masks (dict, optional): Encoded masks to write into the
+                shards with the patch, instead of the files.
         """
         if self.method == "evaluation":
-            self.result["result"].append({"x": x,
-                                          "y": y,
-                                          "w": self.p_width,
-                                          "h": self.p_height})
+            self.results.add(x, y, self.p_width, self.p_height)
 
         elif self.method == "classification":
-            self.result["result"].append({"x": x,
-                                          "y": y,
-                                          "w": self.p_width,
-                                          "h": self.p_height,
-                                          "class": cls})
+            self.results.add(
+                x, y, self.p_width, self.p_height, classes=[cls])
 
         elif self.method == "detection":
             bbs = []
             for cls in self.classes:
-                for bb in self.find_bbs(x, y, cls):
-                    bbs.append({"x": bb["x"],
-                                "y": bb["y"],
-                                "w": bb["w"],
-                                "h": bb["h"],
-                                "class": bb["class"]})
+                bbs.extend(self.find_bbs(x, y, cls))
             if bbs:
-                self.result["result"].append({"x": x,
-                                              "y": y,
-                                              "w": self.p_width,
-                                              "h": self.p_height,
-                                              "bbs": bbs})
+                self.results.add(
+                    x, y, self.p_width, self.p_height, bbs=bbs)
 
         elif self.method == "segmentation":
-            masks = []
+            mask_classes = []
             for cls in self.classes:
-                for mask in self.find_masks(x, y, cls):
-                    masks.append({"coords": mask["coords"],
-                                  "class": mask["class"]})
-            self.result["result"].append({"x": x,
-                                          "y": y,
-                                          "w": self.p_width,
-                                          "h": self.p_height,
-                                          "masks": masks})
+                for mask in self.find_masks(x, y, cls, shard_masks):
+                    mask_classes.append(mask["class"])
+            self.results.add(
+                x, y, self.p_width, self.p_height, classes=mask_classes)
 
         else:
             raise NotImplementedError
@@ -268,6 +362,9 @@ class Patcher:
              = [small_x, small_y, large_x, large_y]
              = [bbleft, bbtop, bbright, bbbottom]
 
+        The boxes near the patch are looked up with the spatial index, so the
+        cost does not grow with the number of the annotations.
+
         Args:
             x (int): X-axis offset of patch.
             y (int): Y-axis offset of patch.
@@ -275,168 +372,80 @@ class Patcher:
                 area.
 
         """
-        if not self.patch_on_annotation(cls, x, y):
+        if not self.object_centric and not self.patch_on_annotation(cls, x, y):
             return []
-        else:
-            # Find bounding boxes which are on the patch
-            if cls == "foreground":
-                return []
-            coords = self.annotation.mask_coords[cls]
-            for idx, coord in enumerate(coords):
-                if len(coord) != 4:
-                    coords[idx] = self.to_bb(coord)
-            coords = np.array(coords)
-
-            idx_of_bb_on_patch = self.corner_on_patch(coords, x, y)
-            idx_of_bb_on_patch += self.side_on_patch(coords, x, y)
-            idx_of_bb_on_patch += self.annotation_cover_patch(coords, x, y)
-
-            idx_of_bb_on_patch = list(set(idx_of_bb_on_patch))
-
-            bbs_raw = coords[idx_of_bb_on_patch]
-            bbs = []
-            for bb_raw in bbs_raw:
-                x1 = bb_raw[:, 0].min()
-                y1 = bb_raw[:, 1].min()
-                x2 = bb_raw[:, 0].max()
-                y2 = bb_raw[:, 1].max()
-                bbx = int(max(x1 - x, 0))
-                bby = int(max(y1 - y, 0))
-                bbw = int(min(x2 - x1 + bbx, self.p_width)) - bbx
-                bbh = int(min(y2 - y1 + bby, self.p_height)) - bby
-                bb = {"x": bbx,
-                      "y": bby,
-                      "w": bbw,
-                      "h": bbh,
-                      "class": cls}
-                bbs.append(bb)
-            return bbs
-
-    def corner_on_patch(self, coords, x, y):
-        """Check if at least one of the corners is on the patch.
-
-        Args:
-            coords (np.array) : Coordinations of annotations.
-            px (int) : X coordinate of left top corner of the patch.
-            py (int) : Y coordinate of left top corner of the patch.
-
-        Returns:
-            idx_of_bb_on_patch (list): List of np.int64s which are the indices
-                of bounding boxes on the patch.
-        """
-        bblefts = np.min(coords, axis=1)[:, 0]
-        bbtops = np.min(coords, axis=1)[:, 1]
-        bbrights = np.max(coords, axis=1)[:, 0]
-        bbbottoms = np.max(coords, axis=1)[:, 1]
-
-        patch_left = x
-        patch_right = x + self.p_width
-        patch_top = y
-        patch_bottom = y + self.p_height
-
-        left_on_patch = (patch_left <= bblefts) & (bblefts <= patch_right)
-        right_on_patch = (patch_left <= bbrights) & (bbrights <= patch_right)
-        top_on_patch = (patch_top <= bbtops) & (bbtops <= patch_bottom)
-        bottom_on_patch = (patch_top <= bbbottoms) & (
-            bbbottoms <= patch_bottom)
-
-        topleft_on_patch = left_on_patch & top_on_patch
-        topright_on_patch = right_on_patch & top_on_patch
-        bottomleft_on_patch = left_on_patch & bottom_on_patch
-        bottomright_on_patch = right_on_patch & bottom_on_patch
-
-        idx_of_bb_on_patch = topleft_on_patch | topright_on_patch |\
-            bottomleft_on_patch | bottomright_on_patch
-        idx_of_bb_on_patch = np.where(idx_of_bb_on_patch)[0]
-        return list(idx_of_bb_on_patch)
-
-    def side_on_patch(self, coords, x, y):
-        """Check if at least one of the side is on the patch.
+        if cls == "foreground":
+            return []
+        boxes, index = self.get_bb_index(cls)
+        candidates = index.query(x, y, x + self.p_width, y + self.p_height)
+        bbs = []
+        for idx in self.order_bbs(boxes, candidates, x, y):
+            x1, y1, x2, y2 = boxes[idx]
+            bbx = int(max(x1 - x, 0))
+            bby = int(max(y1 - y, 0))
+            bbw = int(min(x2 - x1 + bbx, self.p_width)) - bbx
+            bbh = int(min(y2 - y1 + bby, self.p_height)) - bby
+            bb = {"x": bbx,
+                  "y": bby,
+                  "w": bbw,
+                  "h": bbh,
+                  "class": cls}
+            bbs.append(bb)
+        return bbs
+
+    def get_bb_index(self, cls):
+        """Get the bounding boxes of a class and their spatial index.
+
+        The boxes are packed from annotation.mask_coords once for each class,
+        without modifying mask_coords.
 
         Args:
-            coords (np.array) : Coordinations of annotations.
-            px (int) : X coordinate of left top corner of the patch.
-            py (int) : Y coordinate of left top corner of the patch.
+            cls (str): Class of the bounding boxes.
 
         Returns:
-            idx_of_bb_on_patch (list): List of np.int64s which are the indices
-                of bounding boxes on the patch.
+            boxes (numpy.ndarray): Left, top, right and bottom of the boxes.
+            index (wsiprocess.spatial.BoxIndex): Spatial index of the boxes.
         """
-        bblefts = np.min(coords, axis=1)[:, 0]
-        bbtops = np.min(coords, axis=1)[:, 1]
-        bbrights = np.max(coords, axis=1)[:, 0]
-        bbbottoms = np.max(coords, axis=1)[:, 1]
+        coords = self.annotation.mask_coords[cls]
+        cached = self.bb_indices.get(cls)
+        if cached is None or cached[0] is not coords or \
+                cached[1] != len(coords):
+            boxes = pack_boxes(coords)
+            index = BoxIndex(boxes, max(self.p_width, self.p_height))
+            cached = (coords, len(coords), boxes, index)
+            # threads may build the same index at once, which is harmless
+            self.bb_indices[cls] = cached
+        return cached[2], cached[3]
+
+    def order_bbs(self, boxes, candidates, x, y):
+        """Select the boxes on a patch, and order them from the top left.
+
+        A box is on the patch if one of its corners or sides is on the patch,
+        or it covers the whole patch. The boxes are sorted by their top, left
+        and index, so that results.json does not depend on the hash seed.
 
-        patch_left = x
-        patch_right = x + self.p_width
-        patch_top = y
-        patch_bottom = y + self.p_height
-
-        left_on_patch = (patch_left <= bblefts) & (bblefts <= patch_right)
-        right_on_patch = (patch_left <= bbrights) & (bbrights <= patch_right)
-        top_on_patch = (patch_top <= bbtops) & (bbtops <= patch_bottom)
-        bottom_on_patch = (patch_top <= bbbottoms) & (
-            bbbottoms <= patch_bottom)
-
-        # One side is on the patch
-        leftside_on_patch = (left_on_patch) &\
-                            (bbtops <= patch_top) &\
-                            (patch_bottom <= bbbottoms)
-        rightside_on_patch = (right_on_patch) &\
-                             (bbtops <= patch_top) &\
-                             (patch_bottom <= bbbottoms)
-        topside_on_patch = (bblefts <= patch_left) &\
-                           (patch_right <= bbrights) &\
-                           (top_on_patch)
-        bottomside_on_patch = (bblefts <= patch_left) &\
-                              (patch_right <= bbrights) &\
-                              (bottom_on_patch)
-
-        # Two sides are on the patch
-        leftrightside_on_patch = (left_on_patch) &\
-                                 (right_on_patch) &\
-                                 (bbtops <= patch_top) &\
-                                 (patch_bottom <= bbbottoms)
-        topbottomside_on_patch = (bblefts <= patch_left) &\
-                                 (patch_right <= bbrights) &\
-                                 (top_on_patch) &\
-                                 (bottom_on_patch)
-
-        idx_of_bb_on_patch = leftside_on_patch | rightside_on_patch | \
-            topside_on_patch | bottomside_on_patch | \
-            leftrightside_on_patch | topbottomside_on_patch
-        idx_of_bb_on_patch = np.where(idx_of_bb_on_patch)[0]
-        idx_of_bb_on_patch = list(set(idx_of_bb_on_patch))
-        return list(idx_of_bb_on_patch)
-
-    def annotation_cover_patch(self, coords, x, y):
-        """Check if the annotation is covering the whole patch.
-
-        Args:
-            coords (np.array) : Coordinations of annotations.
-            px (int) : X coordinate of left top corner of the patch.
-            py (int) : Y coordinate of left top corner of the patch.
+        Args:
+            boxes (numpy.ndarray): Left, top, right and bottom of the boxes.
+            candidates (numpy.ndarray): Indices of the boxes near the patch.
+            x (int): X-axis offset of patch.
+            y (int): Y-axis offset of patch.
 
         Returns:
-            idx_of_bb_on_patch (list): List of np.int64s which are the indices
-                of bounding boxes on the patch.
+            (list): Indices of the boxes on the patch.
         """
-        bblefts = np.min(coords, axis=1)[:, 0]
-        bbtops = np.min(coords, axis=1)[:, 1]
-        bbrights = np.max(coords, axis=1)[:, 0]
-        bbbottoms = np.max(coords, axis=1)[:, 1]
-
-        patch_left = x
+        left, top, right, bottom = boxes[candidates].T
         patch_right = x + self.p_width
-        patch_top = y
         patch_bottom = y + self.p_height
-
-        idx_of_bb_on_patch = (bblefts <= patch_left) &\
-                             (patch_right <= bbrights) &\
-                             (bbtops <= patch_top) &\
-                             (patch_bottom <= bbbottoms)
-        idx_of_bb_on_patch = np.where(idx_of_bb_on_patch)[0]
-        return list(idx_of_bb_on_patch)
+        x_on_patch = ((x <= left) & (left <= patch_right)) | \
+            ((x <= right) & (right <= patch_right))
+        y_on_patch = ((y <= top) & (top <= patch_bottom)) | \
+            ((y <= bottom) & (bottom <= patch_bottom))
+        x_over_patch = (left <= x) & (patch_right <= right)
+        y_over_patch = (top <= y) & (patch_bottom <= bottom)
+        on_patch = (x_on_patch | x_over_patch) & (y_on_patch | y_over_patch)
+        order = np.lexsort(
+            (candidates[on_patch], left[on_patch], top[on_patch]))
+        return candidates[on_patch][order].tolist()
 
     def to_bb(self, coord):
         """Convert coordinates to voc coordinates.
@@ -465,7 +474,7 @@ class Patcher:
                        [xmax, ymin]]
         return outer_coord
 
-    def find_masks(self, x, y, cls):
+    def find_masks(self, x, y, cls, shard_masks=None):
         """Get the masked area corresponding to the given patch area.
 
         Args:
@@ -473,6 +482,8 @@ class Patcher:
             y (int): Y-axis offset of a patch.
             cls (str): Class of the patch or the bounding box or the segmented
                 area.
+            shard_masks (dict, optional): If given, the mask is encoded into
+                it by the class instead of being written to the file.
 
         Returns:
             masks (list): List containing a dict of coords and its class. This
@@ -484,9 +495,12 @@ class Patcher:
             # Find mask coords
             patch_mask = self.annotation.get_patch_mask(
                 cls, x, y, self.p_width, self.p_height)
-            mask_path = "{}/{}/masks/{}/{:06}_{:06}.{}".format(
-                self.save_to, self.filestem, cls, x, y, self.ext)
-            if not self.no_patches:
+            mask_path = self.mask_path(x, y, cls)
+            if shard_masks is not None:
+                _, data = cv2.imencode(
+                    "." + self.ext, patch_mask, (cv2.IMWRITE_PXM_BINARY, 1))
+                shard_masks[cls] = data.tobytes()
+            elif not self.no_patches:
                 cv2.imwrite(mask_path, patch_mask, (cv2.IMWRITE_PXM_BINARY, 1))
             # contours, _ = cv2.findContours(
             #   patch_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
@@ -495,93 +509,102 @@ class Patcher:
             masks.append(mask)
             return masks
 
-    def remove_dup_in_results(self):
-        """Remove duplicate results in self.result["results"]
+    def mask_path(self, x, y, cls):
+        """Path to the mask of a patch for segmentation.
+
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            cls (str): Class of the mask.
+
+        Returns:
+            (str): Path to the png image.
         """
-        results = set()
-        for result in self.result["result"]:
-            results.add(json.dumps(result))
-        self.result["result"] = [json.loads(res) for res in list(results)]
+        return "{}/{}/masks/{}/{:06}_{:06}.{}".format(
+            self.save_to, self.filestem, cls, x, y, self.ext)
 
     def save_results(self):
         """Save the extraction results.
 
-        Saves some metadata with the patches results.
-
-        """
-        self.result["slide"] = self.slide.path
-        self.result["method"] = self.method
-        self.result["wsi_width"] = self.wsi_width
-        self.result["wsi_height"] = self.wsi_height
-        self.result["patch_width"] = self.p_width
-        self.result["patch_height"] = self.p_height
-        self.result["overlap_width"] = self.o_width
-        self.result["overlap_hegiht"] = self.o_height
-        self.result["offset_x"] = self.offset_x
-        self.result["offset_y"] = self.offset_y
-        self.result["ext"] = self.ext
-        self.result["start_sample"] = self.start_sample
-        self.result["finished_sample"] = self.finished_sample
-        self.result["no_patches"] = self.no_patches
-        self.result["on_foreground"] = self.on_foreground
-        self.result["on_annotation"] = self.on_annotation
-        self.result["dot_bbox_width"] = self.dot_bbox_width
-        self.result["dot_bbox_height"] = self.dot_bbox_height
-        self.result["magnification"] = self.magnification
-        self.result["dryrun"] = self.dryrun
-        self.result["save_to"] = str(Path(self.save_to).absolute())
-        self.result["classes"] = sorted(self.classes)
-
-        self.remove_dup_in_results()
+        Saves some metadata with the patches results. The results of the
+        same patch are merged in self.results, and written to results.json
+        one by one not to build the list of them on the memory.
+
+        """
+        result = {}
+        result["slide"] = self.slide.path
+        result["method"] = self.method
+        result["wsi_width"] = self.wsi_width
+        result["wsi_height"] = self.wsi_height
+        result["patch_width"] = self.p_width
+        result["patch_height"] = self.p_height
+        result["overlap_width"] = self.o_width
+        result["overlap_hegiht"] = self.o_height
+        result["offset_x"] = self.offset_x
+        result["offset_y"] = self.offset_y
+        result["ext"] = self.ext
+        result["start_sample"] = self.start_sample
+        result["finished_sample"] = self.finished_sample
+        result["no_patches"] = self.no_patches
+        result["on_foreground"] = self.on_foreground
+        result["on_annotation"] = self.on_annotation
+        result["dot_bbox_width"] = self.dot_bbox_width
+        result["dot_bbox_height"] = self.dot_bbox_height
+        result["magnification"] = self.magnification
+        result["dryrun"] = self.dryrun
+        result["link"] = self.link
+        result["shards"] = \
+            self.shards.suffix if self.shards is not None else None
+        result["memmap"] = self.memmap is not None
+        result["save_to"] = str(Path(self.save_to).absolute())
+        result["classes"] = sorted(self.classes)
 
         with open(
             "{}/{}/results.json".format(self.save_to, self.filestem),
                 "w") as f:
-            json.dump(self.result, f, indent=4)
-
-        coords = pd.DataFrame(self.result["result"])
-        if not self.result["result"]:
+            # same as json.dump(dict(result=[...], **result), f, indent=4)
+            records = self.results.records(self.method, self.mask_path)
+            f.write('{\n    "result": [')
+            separator = "\n        "
+            for record in records:
+                f.write(separator)
+                f.write(json.dumps(record, indent=4).replace(
+                    "\n", "\n        "))
+                separator = ",\n        "
+            f.write("],\n" if separator == "\n        " else "\n    ],\n")
+            f.write(json.dumps(result, indent=4)[2:])
+
+        if self.shards is not None:
+            index = pd.DataFrame(self.shard_index, columns=[
+                "x", "y", "class", "field", "shard", "offset", "size"])
+            index.insert(0, "slide", self.filestem)
+            index.sort_values(by=["x", "y", "class", "field"], inplace=True)
+            index.to_csv("{}/index.csv".format(self.shards.root), index=None)
+
+        if self.link == "manifest":
+            manifest = pd.DataFrame(
+                self.manifest, columns=["x", "y", "class", "path"])
+            manifest.sort_values(by=["x", "y", "class"], inplace=True)
+            manifest.to_csv(
+                "{}/{}/manifest.csv".format(self.save_to, self.filestem),
+                index=None)
+
+        rows, _ = self.results.merge()
+        if not len(rows["x"]):
             return
 
-        coords.sort_values(by=["x", "y"], inplace=True)
-        coords.reset_index(drop=True, inplace=True)
-        if self.method == "classification":
-            for cls in self.classes:
-                coords[cls] = (coords["class"] == cls)
-
-            # aggregate if a patch has multiple classes
-            if coords.duplicated(subset=["x", "y", "w", "h"]).sum() > 0:
-                dup_to_keep = ~coords.duplicated(
-                    subset=["x", "y", "w", "h"], keep="first")
-
-                for i, row in coords[dup_to_keep].iterrows():
-                    dup_x = coords.x == row.x
-                    dup_y = coords.y == row.y
-                    dup_w = coords.w == row.w
-                    dup_h = coords.h == row.h
-                    dup = coords[dup_x & dup_y & dup_w & dup_h]
-                    coords.loc[i, self.classes] = dup[self.classes].any()
-
-                coords.drop_duplicates(
-                    subset=["x", "y", "w", "h"], keep="first", inplace=True)
-
-            coords.drop(columns="class", inplace=True)
-
-        elif self.method == "detection":
-            # column name: bbs
-            # not implemented
-            pass
-
-        elif self.method == "segmentation":
-            # column name: masks
+        coords = pd.DataFrame(
+            {name: rows[name] for name in ("x", "y", "w", "h")})
+        if self.method in ("classification", "segmentation"):
+            flags = self.results.class_flags()
             for cls in self.classes:
-                coords[cls] = False
-
-            def mask_cls_to_column(x):
-                for mask in x.masks:
-                    coords.loc[x.name, mask["class"]] = True
-
-            coords.apply(mask_cls_to_column, axis=1)
+                coords[cls] = flags[:, self.results.class_ids[cls]]
+        if self.method in ("detection", "segmentation"):
+            # column name: bbs or masks, in the format of results.json
+            key = "bbs" if self.method == "detection" else "masks"
+            coords.insert(4, key, [
+                str(record[key]) for record in self.results.records(
+                    self.method, self.mask_path)])
 
         coords.to_csv(
             "{}/{}/coords.csv".format(self.save_to, self.filestem),
@@ -590,6 +613,10 @@ class Patcher:
     def get_patch(self, x, y, classes=False):
         """Extract a single patch.
 
+        Subclasses can override this to select and extract the patches by
+        themselves, and get_patch_parallel() calls it on every point of the
+        grid.
+
         Args:
             x (int): X-axis offset of a patch.
             y (int): Y-axis offset of a patch.
@@ -608,19 +635,68 @@ class Patcher:
                     on_annotation_classes.append(cls)
         else:
             on_annotation_classes = ["foreground"]
-        for cls in on_annotation_classes:
-            if not self.no_patches:
-                patch = self.crop_patch(x, y)
-                self.save_patch(patch, "{}/{}/patches/{}/{:06}_{:06}.{}".format(
-                    self.save_to, self.filestem, cls, x, y, self.ext))
-            self.save_patch_result(x, y, cls)
+        if self.no_patches:
+            for cls in on_annotation_classes:
+                self.save_patch_result(x, y, cls)
+        elif on_annotation_classes:
+            # cropped and encoded once even if on several classes
+            self.save_patch_classes(
+                x, y, on_annotation_classes, self.crop_patch(x, y))
+
+    def get_patch_overridden(self):
+        """Whether a subclass overrides get_patch().
+
+        A subclass overriding get_patch() selects and extracts the patches by
+        itself. Its get_patch() is called on every point of the grid with all
+        the classes, as the patches are not planned for it, and worker_type
+        of "pipeline", "band" and "stream" run it on the worker threads
+        without reading the slide in their own ways.
+
+        Returns:
+            (bool): Whether get_patch() is overridden.
+        """
+        return type(self).get_patch is not Patcher.get_patch
+
+    def extract_patch(self, x, y, classes):
+        """Extract a planned patch for each of its classes.
+
+        The patch is already selected with plan_patches() or plan_objects(),
+        so it is cropped once without checking the masks again.
 
-    def get_patch_parallel(self, classes=False, max_workers=-1):
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            classes (list): Classes of the patch.
+        """
+        self.save_patch_classes(x, y, classes, self.crop_patch(x, y))
+
+    def get_patch_parallel(
+            self, classes=False, max_workers=-1, worker_type="thread",
+            batch_size=64, stage_workers=None):
         """Run get_patch() in parallel.
 
         Args:
             classes (list): Classes to extract.
-            max_workers (int): Workers to run. -1 runs with cores*5 threads.
+            max_workers (int): Workers to run. -1 runs with cores*5 threads,
+                or cores processes.
+            worker_type (str): One of {"thread", "process", "pipeline",
+                "band", "stream"}. Processes are not blocked by the GIL, and
+                each of them opens its own slide handle and reads the masks on
+                the shared memory. Pipeline runs reading, encoding and writing
+                of the patches on separate threads connected with bounded
+                queues. Band reads each row of the grid at once, and cuts the
+                patches out of it. Stream reads the columns of the grid from
+                the top to the bottom only once, sequentially with the pyvips
+                backend. get_patch() overridden in a subclass is called in any
+                of them, as described in get_patch_overridden().
+            batch_size (int): Number of patches a worker process handles in a
+                task.
+            stage_workers (dict, optional): Number of the threads for each
+                stage of the pipeline, ex: {"read": 4, "encode": 8,
+                "write": 2}. Stages not set run with max_workers threads.
+
+        Raises:
+            Exception: The first error raised in the workers.
         """
         for cls in classes:
             assert cls in self.on_annotation, f"on_annotation of {cls} not set"
@@ -629,38 +705,112 @@ class Patcher:
             msg = "max_workers must be 1 or larger, or -1"
             msg += f", got {max_workers}"
             warnings.warn(msg)
+        if self.link and not self.no_patches:
+            self.verify.make_dir(
+                "{}/{}/store".format(self.save_to, self.filestem))
+        if self.shards is not None and not self.no_patches:
+            self.verify.make_dir(str(self.shards.root))
+        if self.memmap is not None and not self.no_patches:
+            self.verify.make_dir(str(self.memmap.root))
         for cls in classes:
-            if not self.no_patches:
+            if self.no_patches or self.shards is not None:
+                continue
+            if self.memmap is None:
                 self.verify.make_dir(
                     "{}/{}/patches/{}".format(
                         self.save_to, self.filestem, cls))
-                if self.method == "segmentation":
-                    self.verify.make_dir(
-                        "{}/{}/masks/{}".format(
-                            self.save_to, self.filestem, cls))
+            if self.method == "segmentation":
+                self.verify.make_dir(
+                    "{}/{}/masks/{}".format(self.save_to, self.filestem, cls))
 
         if self.start_sample:
             self.get_random_sample("start", 3)
 
+        if worker_type not in (
+                "thread", "process", "pipeline", "band", "stream"):
+            raise NotImplementedError(
+                "worker_type={} is not available".format(worker_type))
+        if worker_type == "stream" and self.slide.backend != "pyvips":
+            warnings.warn(
+                "worker_type=stream reads the slide sequentially only with "
+                "the pyvips backend, and reads the rows at random with "
+                "backend={}".format(self.slide.backend))
         if max_workers == -1:
-            max_workers = os.cpu_count()*5
+            if worker_type == "process":
+                max_workers = os.cpu_count()
+            else:
+                max_workers = os.cpu_count()*5
         else:
             max_workers = max_workers
 
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            xs = [iter[0] for iter in self.iterator]
-            ys = [iter[1] for iter in self.iterator]
+        overridden = self.get_patch_overridden()
+        if overridden:
+            xs, ys = self.iterator.coords()
+            on_classes = np.ones((len(xs), len(classes)), dtype=bool)
+            plan_classes = list(classes)
+        elif self.sample:
+            xs, ys, on_classes, plan_classes = self.plan_samples(classes)
+        elif self.object_centric:
+            xs, ys, on_classes, plan_classes = self.plan_objects(classes)
+        else:
+            xs, ys, on_classes, plan_classes = self.plan_patches(classes)
+        if self.memmap is not None and not self.no_patches:
+            self.memmap.create(
+                xs, ys, on_classes, plan_classes, *self.output_size())
+        patches = self.iter_plan(xs, ys, on_classes, plan_classes)
+        desc = f"[{self.filepath} {self.p_width}x{self.p_height}]"
+        if self.no_patches and not overridden:
+            # nothing to read from the slide, so the plan is the result
             if self.verbose:
-                desc = f"[{self.filepath} {self.p_width}x{self.p_height}]"
-                list(tqdm(executor.map(
-                    self.get_patch, xs, ys,
-                    [classes for _ in self.iterator]
-                ), desc=desc, total=len(self.iterator)))
-            else:
-                executor.map(
-                    self.get_patch, xs, ys,
-                    [classes for _ in self.iterator]
-                )
+                patches = tqdm(patches, desc=desc, total=len(xs))
+            for x, y, patch_classes in patches:
+                for cls in patch_classes:
+                    self.save_patch_result(x, y, cls)
+        elif worker_type == "process":
+            self.get_patch_processes(
+                patches, len(xs), max_workers, batch_size, desc)
+        elif worker_type == "band" and not overridden:
+            try:
+                self.get_patch_bands(
+                    self.plan_bands(xs, ys, on_classes, plan_classes),
+                    len(xs), max_workers, desc)
+            finally:
+                self.slide.release_handles()
+        elif worker_type == "stream" and not overridden:
+            try:
+                self.get_patch_stream(
+                    xs, ys, on_classes, plan_classes, max_workers, desc)
+            finally:
+                self.slide.release_handles()
+        elif worker_type == "pipeline" and not overridden:
+            try:
+                self.get_patch_pipeline(
+                    patches, len(xs), max_workers, stage_workers, desc)
+            finally:
+                self.slide.release_handles()
+        else:
+            extract = self.get_patch if overridden else self.extract_patch
+            progress = tqdm(desc=desc, total=len(xs), disable=not self.verbose)
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    for _ in bounded_map(
+                            executor, lambda patch: extract(*patch),
+                            patches, window=4*max_workers):
+                        progress.update()
+            finally:
+                # the handles of the worker threads are no longer used
+                self.slide.release_handles()
+            progress.close()
+
+        if self.shards is not None:
+            self.shards.close()
+        if self.memmap is not None:
+            self.memmap.close()
+
+        if self.verbose and self.slide.cache is not None:
+            print("tile cache: {}".format(self.slide.cache.stats()))
+        if self.verbose and not self.no_patches:
+            print("encoder: {}".format(self.encoder.stats()))
 
         # save results
         self.save_results()
@@ -668,13 +818,818 @@ class Patcher:
         if self.finished_sample:
             self.get_random_sample("finished", 3)
 
+    def get_patch_processes(
+            self, patches, total, max_workers, batch_size, desc=""):
+        """Run get_patch() on worker processes.
+
+        The masks are placed on the shared memory not to be pickled for each
+        task, and the patches are sent to the workers in batches. The results
+        of each batch are streamed back and merged into self.results.
+
+        Args:
+            patches (iterator): Patches to extract, from iter_plan().
+            total (int): Number of the patches.
+            max_workers (int): Number of worker processes.
+            batch_size (int): Number of patches in a batch.
+            desc (str): Description of the progress bar.
+        """
+        shared_masks = SharedMasks({
+            cls: self.annotation.get_mask(cls) for cls in self.masks})
+        try:
+            with ProcessPoolExecutor(
+                    max_workers=max_workers,
+                    initializer=_init_process_worker,
+                    initargs=(self._worker_copy(), shared_masks)) as executor:
+                batches = iter(lambda: list(islice(patches, batch_size)), [])
+                progress = tqdm(
+                    desc=desc, total=total, disable=not self.verbose)
+                for done in bounded_map(
+                        executor, _get_patch_batch, batches,
+                        window=2*max_workers):
+                    self.results.extend(done["result"])
+                    self.manifest.extend(done["manifest"])
+                    self.shard_index.extend(done["shard_index"])
+                    self.encoder.add(*done["encoded"])
+                    progress.update(done["size"])
+                progress.close()
+        finally:
+            shared_masks.close(unlink=True)
+
+    def get_patch_pipeline(
+            self, patches, total, max_workers, stage_workers=None, desc=""):
+        """Run get_patch() as a pipeline of read, encode and write stages.
+
+        Reading from the slide, converting and encoding the patches, and
+        writing them to the disk overlap each other, and a slow disk does not
+        stall the threads reading the slide. The depths of the queues are
+        kept in self.pipeline_stats, and shown if verbose is set.
+
+        Args:
+            patches (iterator): Patches to extract, from iter_plan().
+            total (int): Number of the patches.
+            max_workers (int): Number of threads of the stages not set in
+                stage_workers.
+            stage_workers (dict, optional): Number of threads for each of
+                "read", "encode" and "write".
+            desc (str): Description of the progress bar.
+        """
+        workers = {"read": max_workers,
+                   "encode": max_workers,
+                   "write": max_workers}
+        workers.update({k: v for k, v in (stage_workers or {}).items() if v})
+        pipeline = Pipeline(maxsize=2*max(workers.values()))
+        pipeline.add_stage("read", self._read_stage, workers["read"])
+        pipeline.add_stage("encode", self._encode_stage, workers["encode"])
+        pipeline.add_stage("write", self._write_stage, workers["write"])
+        progress = tqdm(desc=desc, total=total, disable=not self.verbose)
+        pipeline.run(patches, callback=progress.update)
+        progress.close()
+        self.pipeline_stats = pipeline.stats()
+        if self.verbose:
+            print(pipeline.report())
+
+    def get_patch_bands(self, bands, total, max_workers, desc=""):
+        """Run get_band() on worker threads.
+
+        Args:
+            bands (iterator): Bands to extract, from plan_bands().
+            total (int): Number of the patches.
+            max_workers (int): Number of worker threads.
+            desc (str): Description of the progress bar.
+        """
+        progress = tqdm(desc=desc, total=total, disable=not self.verbose)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for size in bounded_map(
+                    executor, self.get_band, bands, window=2*max_workers):
+                progress.update(size)
+        progress.close()
+
+    def plan_bands(self, xs, ys, on_classes, plan_classes,
+                   max_band_width=16384):
+        """Group the selected patches into bands along the rows of the grid.
+
+        A band is a run of the patches on the same row, which are next to or
+        overlapping each other. Bands are split at the gaps wider than a patch
+        and at max_band_width, not to read the unused area or too large a
+        region at once.
+
+        Args:
+            xs (numpy.ndarray): X-axis offsets of the selected patches.
+            ys (numpy.ndarray): Y-axis offsets of the selected patches.
+            on_classes (numpy.ndarray): Boolean matrix of the selected patches
+                on each of plan_classes.
+            plan_classes (list): Classes of the columns of on_classes.
+            max_band_width (int): Maximum width of a band.
+
+        Yields:
+            (tuple): Y-axis offset of the band, and the X-axis offsets and the
+                classes of the patches in the band.
+        """
+        order = np.lexsort((xs, ys))
+        patches = self.iter_plan(
+            xs[order], ys[order], on_classes[order], plan_classes)
+        band_y, band = None, []
+        for x, y, patch_classes in patches:
+            if band and (
+                    y != band_y
+                    or x - band[-1][0] > self.p_width
+                    or x + self.p_width - band[0][0] > max_band_width):
+                yield band_y, band
+                band = []
+            band_y = y
+            band.append((x, patch_classes))
+        if band:
+            yield band_y, band
+
+    def get_band(self, band):
+        """Extract the patches in a band.
+
+        The band is read from the slide once, and the patches are cut out of
+        it as views, which are converted to PIL images only to be encoded.
+        With magnification, the band is read on the level 0 and each patch is
+        resized.
+
+        Args:
+            band (tuple): Y-axis offset of the band, and the X-axis offsets
+                and the classes of the patches in the band.
+
+        Returns:
+            (int): Number of the patches in the band.
+        """
+        y, patches = band
+        left = patches[0][0]
+        width = patches[-1][0] + self.p_width - left
+        region = self.slide.crop_array(left, y, width, self.p_height)
+        for x, classes in patches:
+            self.save_patch_classes(
+                x, y, classes, region[:, x - left:x - left + self.p_width])
+        return len(patches)
+
+    def get_patch_stream(self, xs, ys, on_classes, plan_classes, max_workers,
+                         desc=""):
+        """Extract the patches reading the slide from the top to the bottom.
+
+        The rows of the grid are read in order with Slide.scan_rows(), and
+        the patches cut out of them are encoded and written on the worker
+        threads.
+
+        Args:
+            xs (numpy.ndarray): X-axis offsets of the selected patches.
+            ys (numpy.ndarray): Y-axis offsets of the selected patches.
+            on_classes (numpy.ndarray): Boolean matrix of the selected patches
+                on each of plan_classes.
+            plan_classes (list): Classes of the columns of on_classes.
+            max_workers (int): Number of worker threads.
+            desc (str): Description of the progress bar.
+        """
+        order = np.lexsort((xs, ys))
+        xs, ys, on_classes = xs[order], ys[order], on_classes[order]
+        tops, starts = np.unique(ys, return_index=True)
+        stops = np.append(starts[1:], len(xs))
+        # only the columns the patches cover are read
+        left = int(xs.min()) if len(xs) else 0
+        width = int(xs.max()) + self.p_width - left if len(xs) else 0
+
+        def patches():
+            rows = self.slide.scan_rows(
+                tops.tolist(), self.p_height, width, left)
+            for (_, region), start, stop in zip(rows, starts, stops):
+                for x, y, classes in self.iter_plan(
+                        xs[start:stop], ys[start:stop],
+                        on_classes[start:stop], plan_classes):
+                    yield x, y, classes, \
+                        region[:, x - left:x - left + self.p_width]
+
+        progress = tqdm(desc=desc, total=len(xs), disable=not self.verbose)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in bounded_map(
+                    executor, lambda patch: self.save_patch_classes(*patch),
+                    patches(), window=4*max_workers):
+                progress.update()
+        progress.close()
+
+    def save_patch_classes(self, x, y, classes, patch):
+        """Encode a patch once and save it for each of the classes.
+
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            classes (list): Classes of the patch.
+            patch (PIL.Image.Image or numpy.ndarray): The patch.
+        """
+        patch = self.process_patch(patch)
+        if self.memmap is not None:
+            self.write_patch_memmap(x, y, classes, patch)
+        else:
+            self.write_patch_classes(x, y, classes, self.encode_patch(patch))
+
+    def write_patch_memmap(self, x, y, classes, patch):
+        """Write a patch into the memory-mapped array without encoding.
+
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            classes (list): Classes of the patch.
+            patch (PIL.Image.Image or numpy.ndarray): The patch converted
+                with process_patch().
+        """
+        self.memmap.write(x, y, patch)
+        for cls in classes:
+            self.save_patch_result(x, y, cls)
+
+    def write_patch_classes(self, x, y, classes, data):
+        """Write an encoded patch for each of the classes.
+
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            classes (list): Classes of the patch.
+            data (bytes): Encoded image.
+        """
+        if self.shards is not None:
+            self.write_patch_shard(x, y, classes, data)
+            return
+        stored = self.store_patch(data) if self.link else None
+        for cls in classes:
+            save_as = "{}/{}/patches/{}/{:06}_{:06}.{}".format(
+                self.save_to, self.filestem, cls, x, y, self.ext)
+            if stored is None:
+                self.write_patch(data, save_as)
+            else:
+                self.link_patch(stored, save_as, x, y, cls)
+            self.save_patch_result(x, y, cls)
+
+    def write_patch_shard(self, x, y, classes, data):
+        """Write an encoded patch and its masks into the shards as a sample.
+
+        The files of the sample are named as WebDataset does, such as
+        "<slide>_<x>_<y>.jpg", "<slide>_<x>_<y>.cls" with the classes and
+        "<slide>_<x>_<y>.<class>.mask.jpg" for segmentation.
+
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            classes (list): Classes of the patch.
+            data (bytes): Encoded image.
+        """
+        shard_masks = {} if self.method == "segmentation" else None
+        for cls in classes:
+            self.save_patch_result(x, y, cls, shard_masks)
+        fields = {self.ext: data, "cls": " ".join(classes).encode()}
+        for cls, mask in (shard_masks or {}).items():
+            fields["{}.mask.{}".format(cls, self.ext)] = mask
+        offsets = self.shards.write("{}_{:06}_{:06}".format(
+            self.shards.prefix, x, y), fields)
+        for cls in classes:
+            self.shard_index.append(
+                (x, y, cls, "patch") + offsets[self.ext])
+        for cls in (shard_masks or {}):
+            self.shard_index.append(
+                (x, y, cls, "mask") +
+                offsets["{}.mask.{}".format(cls, self.ext)])
+
+    def store_patch(self, data):
+        """Write an encoded patch to the store named by its content.
+
+        Args:
+            data (bytes): Encoded image.
+
+        Returns:
+            (str): Path to the patch in the store.
+        """
+        stored = "{}/{}/store/{}.{}".format(
+            self.save_to, self.filestem, hashlib.sha1(data).hexdigest(),
+            self.ext)
+        if not os.path.exists(stored):
+            # another worker may write the same content at the same time
+            temp = "{}.{}.{}.tmp".format(
+                stored, os.getpid(), threading.get_ident())
+            self.write_patch(data, temp)
+            os.replace(temp, stored)
+        return stored
+
+    def link_patch(self, stored, save_as, x, y, cls):
+        """Put a patch in the store into the directory of a class.
+
+        Args:
+            stored (str): Path to the patch in the store.
+            save_as (str): Path of the patch in the directory of the class.
+            x (int): X-axis offset of the patch.
+            y (int): Y-axis offset of the patch.
+            cls (str): Class of the patch.
+        """
+        if self.link == "manifest":
+            self.manifest.append({
+                "x": x, "y": y, "class": cls,
+                "path": os.path.relpath(
+                    stored, "{}/{}".format(self.save_to, self.filestem))})
+            return
+        if os.path.lexists(save_as):
+            os.remove(save_as)
+        if self.link == "hardlink":
+            os.link(stored, save_as)
+        else:
+            os.symlink(
+                os.path.relpath(stored, os.path.dirname(save_as)), save_as)
+
+    def _read_stage(self, patch):
+        x, y, classes = patch
+        return x, y, classes, self.crop_patch(x, y)
+
+    def _encode_stage(self, patch):
+        x, y, classes, image = patch
+        image = self.process_patch(image)
+        if self.memmap is not None:
+            return x, y, classes, image
+        return x, y, classes, self.encode_patch(image)
+
+    def _write_stage(self, patch):
+        x, y, classes, data = patch
+        if self.memmap is not None:
+            self.write_patch_memmap(x, y, classes, data)
+        else:
+            self.write_patch_classes(x, y, classes, data)
+        return 1
+
+    def _worker_copy(self):
+        """Copy of the patcher to send to the worker processes.
+
+        The masks and the results are left out, because the masks are shared
+        with SharedMasks and the results are sent back in batches.
+        """
+        annotation = copy.copy(self.annotation)
+        annotation.masks = {}
+        annotation.mask_store = {}
+        patcher = copy.copy(self)
+        patcher.annotation = annotation
+        patcher.masks = annotation.masks
+        patcher.results = ResultStore(self.results.classes)
+        patcher.manifest = []
+        patcher.shard_index = []
+        patcher.bb_indices = {}
+        return patcher
+
+    def plan_patches(self, classes, regions=None):
+        """Select the patches to extract on the whole grid at once.
+
+        The coverages of all the patches in the regions from plan_regions()
+        are computed for every class with array operations on the low
+        resolution masks, and on_foreground and on_annotation are applied to
+        them. Only the selected patches have to be sent to the workers.
+
+        The selected patches are sorted along the curve of self.order, in
+        chunks of the size of the tiles of the slide.
+
+        Args:
+            classes (list): Classes to extract.
+            regions (list, optional): Regions from plan_regions() to plan. As
+                default, all the regions.
+
+        Returns:
+            xs (numpy.ndarray): X-axis offsets of the selected patches.
+            ys (numpy.ndarray): Y-axis offsets of the selected patches.
+            on_classes (numpy.ndarray): Boolean matrix with the shape of
+                (len(xs), len(plan_classes)). True if a patch is on a class.
+            plan_classes (list): Classes of the columns of on_classes.
+        """
+        plan_classes = list(classes) if self.on_annotation else ["foreground"]
+        if regions is None:
+            regions = self.plan_regions(classes)
+        planned = []
+        for region in regions:
+            if isinstance(region, PatchRegion):
+                planned.append(self.plan_region(region, plan_classes))
+            else:
+                planned.extend(
+                    self.select_patches(xs, ys, plan_classes)
+                    for xs, ys in region.chunks())
+        if not planned:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                    np.zeros((0, len(plan_classes)), dtype=bool), plan_classes)
+        xs, ys, on_classes = map(np.concatenate, zip(*planned))
+        if self.order != "raster":
+            order = traversal_order(
+                xs, ys, self.slide.tile_width, self.slide.tile_height,
+                self.order)
+            xs, ys, on_classes = xs[order], ys[order], on_classes[order]
+        return xs, ys, on_classes, plan_classes
+
+    def plan_objects(self, classes):
+        """Plan the patches around the annotated objects.
+
+        The bounding boxes of the objects are visited from the top left, and
+        an object inside one of the patches planned so far is added to its
+        classes instead of making a new patch. The cost depends on the number
+        of the objects, not on the size of the slide.
+
+        Args:
+            classes (list): Classes to extract.
+
+        Returns:
+            xs (numpy.ndarray): X-axis offsets of the planned patches.
+            ys (numpy.ndarray): Y-axis offsets of the planned patches.
+            on_classes (numpy.ndarray): Boolean matrix with the shape of
+                (len(xs), len(plan_classes)). True if a patch has an object of
+                a class.
+            plan_classes (list): Classes of the columns of on_classes.
+        """
+        plan_classes = [cls for cls in classes if cls != "foreground"]
+        boxes = [pack_boxes(self.annotation.mask_coords.get(cls, []))
+                 for cls in plan_classes]
+        labels = np.concatenate(
+            [np.full(len(b), i) for i, b in enumerate(boxes)] + [[]])
+        boxes = np.concatenate(boxes + [np.zeros((0, 4))])
+        planned = {}
+        buckets = {}
+        for i in np.lexsort((boxes[:, 0], boxes[:, 1])):
+            if self.object_centric == "center":
+                patches = [self.center_patch(boxes[i], buckets)]
+            else:
+                patches = self.grid_patches(boxes[i], planned)
+            for patch in patches:
+                planned.setdefault(patch, set()).add(int(labels[i]))
+
+        patches = sorted(planned)
+        if self.dryrun:
+            patches = patches[:100]
+        xs = np.array([x for x, _ in patches], dtype=np.int64)
+        ys = np.array([y for _, y in patches], dtype=np.int64)
+        on_classes = np.zeros((len(patches), len(plan_classes)), dtype=bool)
+        for row, patch in enumerate(patches):
+            on_classes[row, list(planned[patch])] = True
+        if self.order != "raster" and len(xs):
+            order = traversal_order(
+                xs, ys, self.slide.tile_width, self.slide.tile_height,
+                self.order)
+            xs, ys, on_classes = xs[order], ys[order], on_classes[order]
+        return xs, ys, on_classes, plan_classes
+
+    def plan_samples(self, classes, batch_size=256, max_draws=None):
+        """Plan a fixed number of patches per class drawn at random.
+
+        Points are drawn uniformly on the mask of each class, so a patch of
+        the grid is drawn in proportion to the area of the mask it covers.
+        Each point is moved to the patch of the grid containing it, and the
+        patch is kept if it passes on_foreground and on_annotation of the
+        class and is not drawn before. Drawing stops as soon as the class
+        has self.sample patches, so the cost depends on the number of the
+        samples, not on the size of the grid.
+
+        Args:
+            classes (list): Classes to extract.
+            batch_size (int): Number of the points drawn at once.
+            max_draws (int, optional): Maximum number of the points drawn for
+                a class. As default, 100 times the number of the samples.
+
+        Returns:
+            xs (numpy.ndarray): X-axis offsets of the sampled patches.
+            ys (numpy.ndarray): Y-axis offsets of the sampled patches.
+            on_classes (numpy.ndarray): Boolean matrix with the shape of
+                (len(xs), len(plan_classes)). True if a patch is sampled for
+                a class.
+            plan_classes (list): Classes of the columns of on_classes.
+        """
+        plan_classes = list(classes) if self.on_annotation else ["foreground"]
+        rng = np.random.default_rng(self.seed)
+        grid_xs, grid_ys = self.iterator.xs, self.iterator.ys
+        planned = {}
+        # the order of the classes can differ run by run
+        for cls in sorted(plan_classes):
+            i = plan_classes.index(cls)
+            if isinstance(self.sample, dict):
+                quota = int(self.sample.get(cls, 0))
+            else:
+                quota = int(self.sample)
+            limit = 100 * quota if max_draws is None else max_draws
+            mask = self.annotation.get_mask(cls)
+            sampled = []
+            seen = set()
+            draws = 0
+            while len(sampled) < quota and draws < limit:
+                n = min(batch_size, limit - draws)
+                draws += n
+                px, py = mask.sample_points(rng, n)
+                if len(px) == 0:
+                    break
+                col = np.searchsorted(grid_xs, px, side="right") - 1
+                row = np.searchsorted(grid_ys, py, side="right") - 1
+                xs = grid_xs[np.maximum(col, 0)].astype(np.int64)
+                ys = grid_ys[np.maximum(row, 0)].astype(np.int64)
+                if self.rois is not None:
+                    on_rois = self.patches_on_rois(xs, ys)
+                    xs, ys = xs[on_rois], ys[on_rois]
+                xs, ys, _ = self.select_patches(xs, ys, [cls])
+                for patch in zip(xs.tolist(), ys.tolist()):
+                    if patch not in seen:
+                        seen.add(patch)
+                        sampled.append(patch)
+                        if len(sampled) == quota:
+                            break
+            if len(sampled) < quota:
+                warnings.warn("only {} patches of {} are sampled".format(
+                    len(sampled), cls))
+            for patch in sampled:
+                planned.setdefault(patch, set()).add(i)
+
+        patches = sorted(planned)
+        xs = np.array([x for x, _ in patches], dtype=np.int64)
+        ys = np.array([y for _, y in patches], dtype=np.int64)
+        on_classes = np.zeros((len(patches), len(plan_classes)), dtype=bool)
+        for row, patch in enumerate(patches):
+            on_classes[row, list(planned[patch])] = True
+        if self.order != "raster" and len(xs):
+            order = traversal_order(
+                xs, ys, self.slide.tile_width, self.slide.tile_height,
+                self.order)
+            xs, ys, on_classes = xs[order], ys[order], on_classes[order]
+        return xs, ys, on_classes, plan_classes
+
+    def patches_on_rois(self, xs, ys):
+        """Check if the patches overlap any of the rois.
+
+        Args:
+            xs (numpy.ndarray): X-axis offsets of the patches.
+            ys (numpy.ndarray): Y-axis offsets of the patches.
+
+        Returns:
+            (numpy.ndarray): Whether each patch overlaps the rois.
+        """
+        left, top = self.rois[:, 0], self.rois[:, 1]
+        right, bottom = left + self.rois[:, 2], top + self.rois[:, 3]
+        xs, ys = xs[:, None], ys[:, None]
+        return ((xs < right) & (left < xs + self.p_width) &
+                (ys < bottom) & (top < ys + self.p_height)).any(axis=1)
+
+    def center_patch(self, box, buckets):
+        """Find a planned patch containing a box, or a patch centered on it.
+
+        Args:
+            box (numpy.ndarray): Left, top, right and bottom of the box.
+            buckets (dict): Planned patches bucketed by the patch size, which
+                is updated with the new patch.
+
+        Returns:
+            (tuple): X-axis and Y-axis offsets of the patch.
+        """
+        left, top, right, bottom = box
+        for bx in range(int((right - self.p_width) // self.p_width),
+                        int(left // self.p_width) + 1):
+            for by in range(int((bottom - self.p_height) // self.p_height),
+                            int(top // self.p_height) + 1):
+                for x, y in buckets.get((bx, by), []):
+                    if x <= left and right <= x + self.p_width and \
+                            y <= top and bottom <= y + self.p_height:
+                        return x, y
+        x = int(round((left + right - self.p_width) / 2))
+        y = int(round((top + bottom - self.p_height) / 2))
+        x = min(max(x, 0), max(self.wsi_width - self.p_width, 0))
+        y = min(max(y, 0), max(self.wsi_height - self.p_height, 0))
+        bucket = buckets.setdefault(
+            (x // self.p_width, y // self.p_height), [])
+        if (x, y) not in bucket:
+            bucket.append((x, y))
+        return x, y
+
+    def grid_patches(self, box, planned):
+        """Find the patches of the grid to cover a box.
+
+        A box fitting in a patch of the grid is covered by a planned patch if
+        any, or by the patch which places the box nearest to its center. A
+        box larger than a patch is covered by all the patches overlapping it.
+
+        Args:
+            box (numpy.ndarray): Left, top, right and bottom of the box.
+            planned (dict): Patches planned so far.
+
+        Returns:
+            (list): X-axis and Y-axis offsets of the patches.
+        """
+        left, top, right, bottom = box
+        xs, ys = self.iterator.xs, self.iterator.ys
+        x0 = np.searchsorted(xs, right - self.p_width, side="left")
+        x1 = np.searchsorted(xs, left, side="right")
+        y0 = np.searchsorted(ys, bottom - self.p_height, side="left")
+        y1 = np.searchsorted(ys, top, side="right")
+        if x0 < x1 and y0 < y1:
+            for i in range(x0, x1):
+                for j in range(y0, y1):
+                    if (int(xs[i]), int(ys[j])) in planned:
+                        return [(int(xs[i]), int(ys[j]))]
+            i = x0 + np.abs(
+                xs[x0:x1] + self.p_width / 2 - (left + right) / 2).argmin()
+            j = y0 + np.abs(
+                ys[y0:y1] + self.p_height / 2 - (top + bottom) / 2).argmin()
+            return [(int(xs[i]), int(ys[j]))]
+        x0 = np.searchsorted(xs, left - self.p_width, side="right")
+        x1 = np.searchsorted(xs, right, side="left")
+        y0 = np.searchsorted(ys, top - self.p_height, side="right")
+        y1 = np.searchsorted(ys, bottom, side="left")
+        return [(int(x), int(y)) for x in xs[x0:x1] for y in ys[y0:y1]]
+
+    def plan_regions(self, classes):
+        """Find the regions of the grid which can have patches to extract.
+
+        A patch not overlapping the masks is never selected if the threshold
+        of the coverage is positive. So the grid is limited to the cells
+        overlapping the bounding boxes of the connected components of the
+        foreground and the annotations, and the rois. The cells are the same
+        as the full grid, and the regions of the connected cells can be
+        planned and extracted independently.
+
+        Args:
+            classes (list): Classes to extract.
+
+        Returns:
+            regions (list): wsiprocess.grid.PatchRegion objects, or the whole
+                grid as wsiprocess.grid.PatchGrid if it can not be limited.
+        """
+        plan_classes = list(classes) if self.on_annotation else ["foreground"]
+        conditions = []
+        if self.on_foreground and self.on_foreground > 0:
+            conditions.append(
+                self.annotation.get_mask("foreground").bounding_boxes())
+        if self.on_annotation and plan_classes and \
+                all(self.on_annotation[cls] > 0 for cls in plan_classes):
+            conditions.append(np.concatenate([
+                self.annotation.get_mask(cls).bounding_boxes()
+                for cls in plan_classes]))
+        if self.rois is not None:
+            conditions.append(np.concatenate(
+                [self.rois[:, :2], self.rois[:, :2] + self.rois[:, 2:]],
+                axis=1))
+        if not conditions:
+            return [self.iterator]
+        cells = None
+        for boxes in conditions:
+            overlap = self.iterator.cells(boxes, self.p_width, self.p_height)
+            cells = overlap if cells is None else cells & overlap
+        return self.iterator.regions(cells)
+
+    def plan_region(self, region, plan_classes, leaf_size=256):
+        """Select the patches in a region from coarse blocks to fine ones.
+
+        The region is divided into quadrants recursively. The area covered by
+        the masks in the union of the patches of a quadrant is computed in
+        O(1) with the integral images, and it bounds the coverages of all the
+        patches in the quadrant. If it is too small for any patch to reach
+        the threshold, the quadrant is rejected, and if the uncovered area is
+        too small for any patch to fall below it, the quadrant is accepted as
+        a whole. Only the quadrants on the borders of the masks are divided
+        down to leaf_size cells and checked patch by patch, so the cost
+        follows the length of the borders rather than the area.
+
+        Args:
+            region (wsiprocess.grid.PatchRegion): Region to plan.
+            plan_classes (list): Classes to check.
+            leaf_size (int): Number of the cells in a quadrant to check patch
+                by patch.
+
+        Returns:
+            xs (numpy.ndarray): X-axis offsets of the selected patches.
+            ys (numpy.ndarray): Y-axis offsets of the selected patches.
+            on_classes (numpy.ndarray): Boolean matrix of the selected patches
+                on each of plan_classes.
+        """
+        accepted = [], [], []
+        leaves = [], []
+        blocks = [(0, len(region.xs), 0, len(region.ys))]
+        while blocks:
+            c0, c1, r0, r1 = blocks.pop()
+            cells = region.cells[c0:c1, r0:r1]
+            if not cells.any():
+                continue
+            state = self.block_state(
+                region.xs[c0], region.ys[r0],
+                region.xs[c1 - 1] + self.p_width,
+                region.ys[r1 - 1] + self.p_height, plan_classes)
+            if state is False:
+                continue
+            col, row = np.nonzero(cells)
+            xs = region.xs[c0 + col].astype(np.int64)
+            ys = region.ys[r0 + row].astype(np.int64)
+            if state is not None:
+                accepted[0].append(xs)
+                accepted[1].append(ys)
+                accepted[2].append(np.tile(state, (len(xs), 1)))
+            elif cells.size <= leaf_size:
+                leaves[0].append(xs)
+                leaves[1].append(ys)
+            else:
+                cm = (c0 + c1) // 2 if c1 - c0 > 1 else c1
+                rm = (r0 + r1) // 2 if r1 - r0 > 1 else r1
+                for block in [(c0, cm, r0, rm), (c0, cm, rm, r1),
+                              (cm, c1, r0, rm), (cm, c1, rm, r1)]:
+                    if block[0] < block[1] and block[2] < block[3]:
+                        blocks.append(block)
+
+        planned = [tuple(map(np.concatenate, accepted))] if accepted[0] else []
+        if leaves[0]:
+            xs, ys = map(np.concatenate, leaves)
+            planned.extend(
+                self.select_patches(
+                    xs[start:start + 65536], ys[start:start + 65536],
+                    plan_classes)
+                for start in range(0, len(xs), 65536))
+        if not planned:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                    np.zeros((0, len(plan_classes)), dtype=bool))
+        xs, ys, on_classes = map(np.concatenate, zip(*planned))
+        order = np.lexsort((ys, xs))
+        return xs[order], ys[order], on_classes[order]
+
+    def block_state(self, left, top, right, bottom, plan_classes):
+        """Bound the selection of all the patches in a block.
+
+        Args:
+            left (int): Left of the union of the patches.
+            top (int): Top of the union of the patches.
+            right (int): Right of the union of the patches.
+            bottom (int): Bottom of the union of the patches.
+            plan_classes (list): Classes to check.
+
+        Returns:
+            (numpy.ndarray or bool): on_classes shared by all the patches in
+                the block, False if none of them is selected, or None if it
+                differs among the patches.
+        """
+        width, height = right - left, bottom - top
+
+        def state(cls, threshold):
+            if threshold <= 0:
+                return True
+            covered = self.annotation.get_mask(cls).area(
+                left, top, width, height)
+            if covered / self.p_area + _MARGIN < threshold:
+                return False
+            uncovered = width * height - covered
+            if uncovered / self.p_area + _MARGIN < 1 - threshold:
+                return True
+            return None
+
+        on_foreground = True
+        if self.on_foreground:
+            on_foreground = state("foreground", self.on_foreground)
+            if on_foreground is False:
+                return False
+        if not self.on_annotation:
+            return None if on_foreground is None else np.ones(1, dtype=bool)
+        on_classes = [
+            state(cls, self.on_annotation[cls]) for cls in plan_classes]
+        if all(on is False for on in on_classes):
+            return False
+        if on_foreground is None or None in on_classes:
+            return None
+        return np.array(on_classes, dtype=bool)
+
+    def select_patches(self, xs, ys, plan_classes):
+        """Apply on_foreground and on_annotation to the patches.
+
+        Args:
+            xs (numpy.ndarray): X-axis offsets of the patches.
+            ys (numpy.ndarray): Y-axis offsets of the patches.
+            plan_classes (list): Classes to check.
+
+        Returns:
+            xs (numpy.ndarray): X-axis offsets of the selected patches.
+            ys (numpy.ndarray): Y-axis offsets of the selected patches.
+            on_classes (numpy.ndarray): Boolean matrix of the selected patches
+                on each of plan_classes.
+        """
+        selected = np.ones(len(xs), dtype=bool)
+        if self.on_foreground:
+            coverage = self.annotation.get_mask("foreground").coverage(
+                xs, ys, self.p_width, self.p_height)
+            selected &= coverage >= self.on_foreground
+        if self.on_annotation:
+            on_classes = np.zeros((len(xs), len(plan_classes)), dtype=bool)
+            for i, cls in enumerate(plan_classes):
+                coverage = self.annotation.get_mask(cls).coverage(
+                    xs, ys, self.p_width, self.p_height)
+                on_classes[:, i] = coverage >= self.on_annotation[cls]
+            selected &= on_classes.any(axis=1)
+        else:
+            on_classes = np.ones((len(xs), 1), dtype=bool)
+        return xs[selected], ys[selected], on_classes[selected]
+
+    @staticmethod
+    def iter_plan(xs, ys, on_classes, plan_classes):
+        """Iterate over the patches selected with plan_patches().
+
+        Yields:
+            (tuple): X-axis offset, Y-axis offset and the classes of a patch.
+        """
+        for x, y, on_class in zip(xs, ys, on_classes):
+            patch_classes = [
+                cls for cls, on in zip(plan_classes, on_class) if on]
+            yield int(x), int(y), patch_classes
+
     def get_mini_patch_parallel(self, classes=False):
         for cls in classes:
             self.verify.make_dir(
                 "{}/{}/mini_patches/{}".format(
                     self.save_to, self.filestem, cls))
 
-        for patch in self.result["result"]:
+        for patch in self.results.records("detection"):
             for bb in patch["bbs"]:
                 if bb["class"] not in classes:
                     continue
@@ -704,9 +1659,9 @@ class Patcher:
         Returns:
             (bool): Whether the patch is on the foreground area.
         """
-        patch_mask = self.annotation.get_patch_mask(
+        coverage = self.annotation.coverage(
             "foreground", x, y, self.p_width, self.p_height)
-        return (patch_mask.sum() / self.p_area) >= self.on_foreground
+        return coverage >= self.on_foreground
 
     def patch_on_annotation(self, cls, x, y):
         """Check if the patch is on the annotation area of a class.
@@ -720,9 +1675,9 @@ class Patcher:
         Returns:
             (bool): Whether the patch is on the anntation.
         """
-        patch_mask = self.annotation.get_patch_mask(
+        coverage = self.annotation.coverage(
             cls, x, y, self.p_width, self.p_height)
-        return (patch_mask.sum() / self.p_area) >= self.on_annotation[cls]
+        return coverage >= self.on_annotation[cls]
 
     def get_random_sample(self, phase, sample_count=1):
         """Get random patch to check if the patcher can work properly.
@@ -732,29 +1687,155 @@ class Patcher:
             sample_count (int): Number of patches to extract.
         """
         for i in range(sample_count):
-            x = random.choice(self.x_lefttop)
-            y = random.choice(self.y_lefttop)
+            x = int(random.choice(self.x_lefttop))
+            y = int(random.choice(self.y_lefttop))
             patch = self.crop_patch(x, y)
             self.save_patch(patch, "{}/{}/{}_sample/{:06}_{:06}.{}".format(
                 self.save_to, self.filestem, phase, x, y, self.ext))
 
     def crop_patch(self, x, y, w=False, h=False):
+        """Crop a patch from the slide.
+
+        If magnification is set and the size of the patch is not given, the
+        patch is read from the pyramid level for the output size.
+
+        Args:
+            x (int): X-axis offset of a patch.
+            y (int): Y-axis offset of a patch.
+            w (int, optional): Width of a patch. As default, p_width.
+            h (int, optional): Height of a patch. As default, p_height.
+
+        Returns:
+            patch (PIL.Image.Image): Cropped patch.
+        """
+        size = None
+        if self.magnification and not (w or h):
+            size = self.output_size()
         if not w:
             w = self.p_width
         if not h:
             h = self.p_height
-        return self.slide.crop(x, y, w, h)
+        return self.slide.crop(x, y, w, h, size=size)
+
+    def output_size(self):
+        """Width and height of the output patches."""
+        return (int(self.p_width//self.p_scale),
+                int(self.p_height//self.p_scale))
 
     def save_patch(self, patch, save_as):
+        self.write_patch(self.encode_patch(self.process_patch(patch)), save_as)
+
+    def process_patch(self, patch):
+        """Convert a cropped patch to the output mode and size.
+
+        Args:
+            patch (PIL.Image.Image or numpy.ndarray): Patch cropped from the
+                slide.
+
+        Returns:
+            patch (PIL.Image.Image or numpy.ndarray): Patch to encode, of the
+                same type as the input.
+        """
+        if isinstance(patch, np.ndarray):
+            return self.process_patch_array(patch)
         if patch.mode == "RGBA" and self.ext == "jpg":
             warnings.warn(
                 "patch has RGBA data. Discarding alpha to save as jpg")
             patch = patch.convert("RGB")
 
-        if self.magnification:
-            patch = patch.resize((
-                int(self.p_width//self.p_scale),
-                int(self.p_height//self.p_scale)
-            ))
+        if self.magnification and patch.size != self.output_size():
+            patch = patch.resize(self.output_size())
+        return patch
+
+    def process_patch_array(self, patch):
+        """Convert a patch of numpy.ndarray without making a PIL image."""
+        if patch.shape[2] == 4 and self.ext == "jpg":
+            warnings.warn(
+                "patch has RGBA data. Discarding alpha to save as jpg")
+            patch = patch[..., :3]
+
+        if self.magnification and \
+                patch.shape[1::-1] != self.output_size():
+            patch = cv2.resize(
+                patch, self.output_size(), interpolation=cv2.INTER_AREA)
+        return patch
+
+    def encode_patch(self, patch):
+        """Encode a patch as the format of the extension with self.encoder.
+
+        Args:
+            patch (PIL.Image.Image or numpy.ndarray): Patch to encode.
+
+        Returns:
+            (bytes): Encoded image.
+        """
+        return self.encoder.encode(patch)
+
+    def write_patch(self, data, save_as):
+        """Write an encoded patch to the disk.
+
+        Args:
+            data (bytes): Encoded image.
+            save_as (str): Path to save the patch.
+        """
+        with open(save_as, "wb") as f:
+            f.write(data)
+
+
+_worker_patcher = None
 
-        patch.save(save_as)
+
+def _init_process_worker(patcher, shared_masks):
+    """Set up the patcher in a worker process.
+
+    Args:
+        patcher (wsiprocess.patcher.Patcher): Patcher without the masks.
+        shared_masks (wsiprocess.mask.SharedMasks): Masks to attach.
+    """
+    global _worker_patcher
+    # the slide handle inherited by fork must not be shared, while the slide
+    # unpickled with spawn or forkserver has opened its own handle
+    if patcher.slide.pid != os.getpid():
+        patcher.slide.load_slide()
+    if patcher.shards is not None:
+        patcher.shards.tag = str(os.getpid())
+        # the shards are kept open over the batches, and closed on exit
+        multiprocessing.util.Finalize(
+            patcher.shards, patcher.shards.close, exitpriority=0)
+    for cls, mask in shared_masks.attach().items():
+        patcher.annotation.masks[cls] = mask.source
+        patcher.annotation.mask_store[cls] = mask
+    _worker_patcher = patcher
+
+
+def _get_patch_batch(batch):
+    """Extract a batch of patches in a worker process.
+
+    Args:
+        batch (list): Tuples of x, y and classes from Patcher.iter_plan().
+
+    Returns:
+        (dict): Number of the patches handled, their results, the rows of the
+            manifest and the index of the shards, and the counts of the
+            encoder.
+    """
+    patcher = _worker_patcher
+    if patcher.get_patch_overridden():
+        extract = patcher.get_patch
+    else:
+        extract = patcher.extract_patch
+    for x, y, classes in batch:
+        extract(x, y, classes)
+    # the process may end without notice after the batch
+    if patcher.shards is not None:
+        patcher.shards.flush()
+    if patcher.memmap is not None:
+        patcher.memmap.close()
+    done = {"size": len(batch),
+            "result": patcher.results.pop_columns(),
+            "manifest": patcher.manifest,
+            "shard_index": patcher.shard_index,
+            "encoded": patcher.encoder.reset()}
+    patcher.manifest = []
+    patcher.shard_index = []
+    return done
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Pipeline object to run functions as stages connected with bounded queues.
+
+Each stage has its own worker threads and an input queue of a limited size.
+A slow stage makes the queues before it fill up, and the stages before it
+wait for it instead of piling the data up on the RAM. The depths of the
+queues are recorded to show which stage is the bottleneck.
+
+Example:
+    Running three stages:: python
+
+        from wsiprocess.pipeline import Pipeline
+
+        pipeline = Pipeline(maxsize=16)
+        pipeline.add_stage("read", read_fn, workers=4)
+        pipeline.add_stage("encode", encode_fn, workers=8)
+        pipeline.add_stage("write", write_fn, workers=2)
+        pipeline.run(items)
+        print(pipeline.report())
+"""
+import queue
+import threading
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+_STOP = object()
+
+
+def bounded_map(executor, fn, items, window):
+    """Map a function on an executor with a bounded number of tasks in flight.
+
+    Unlike executor.map(), which submits all the items at once, the items are
+    submitted in a sliding window, so the memory for the scheduling stays
+    constant regardless of the number of the items.
+
+    Args:
+        executor (concurrent.futures.Executor): Executor to run fn.
+        fn (callable): Function to apply to each item.
+        items (iterable): Items to give to fn. Consumed lazily.
+        window (int): Maximum number of the submitted and unfinished tasks.
+
+    Yields:
+        Results of fn in the order of completion.
+
+    Raises:
+        Exception: The error raised in fn. Tasks not started yet are cancelled.
+    """
+    window = max(int(window), 1)
+    futures = set()
+    try:
+        for item in items:
+            if len(futures) >= window:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            futures.add(executor.submit(fn, item))
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+class Stage:
+    """A stage of the pipeline.
+
+    Args:
+        name (str): Name of the stage.
+        fn (callable): Function to apply to each item. If it returns None, the
+            item is not passed to the next stage.
+        workers (int): Number of the worker threads.
+        maxsize (int): Size of the input queue.
+
+    Attributes:
+        queue (queue.Queue): Input queue of the stage.
+        items (int): Number of the items processed.
+        busy (float): Total seconds the workers spent in fn.
+        max_depth (int): Maximum depth of the input queue.
+        depth_sum (int): Sum of the depths of the input queue, sampled every
+            time an item is taken.
+    """
+
+    def __init__(self, name, fn, workers=1, maxsize=32):
+        self.name = name
+        self.fn = fn
+        self.workers = max(int(workers), 1)
+        self.maxsize = maxsize
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.items = 0
+        self.busy = 0.
+        self.max_depth = 0
+        self.depth_sum = 0
+        self.lock = threading.Lock()
+        self.running = self.workers
+
+    def record(self, depth, busy):
+        with self.lock:
+            self.items += 1
+            self.busy += busy
+            self.depth_sum += depth
+            self.max_depth = max(self.max_depth, depth)
+
+    def stats(self):
+        """Statistics of the stage.
+
+        Returns:
+            (dict): Workers, processed items, busy seconds and the mean and max
+                depth of the input queue.
+        """
+        mean_depth = self.depth_sum / self.items if self.items else 0
+        return {"workers": self.workers,
+                "items": self.items,
+                "busy": round(self.busy, 3),
+                "mean_depth": round(mean_depth, 2),
+                "max_depth": self.max_depth,
+                "maxsize": self.maxsize}
+
+
+class Pipeline:
+    """Functions run as stages connected with bounded queues.
+
+    Args:
+        maxsize (int): Size of the queue before each stage.
+
+    Attributes:
+        stages (list): wsiprocess.pipeline.Stage objects in order.
+        error (Exception): The first error raised in the stages.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.stages = []
+        self.error = None
+        self.failed = threading.Event()
+        self.lock = threading.Lock()
+
+    def add_stage(self, name, fn, workers=1):
+        """Add a stage at the end of the pipeline.
+
+        Args:
+            name (str): Name of the stage.
+            fn (callable): Function to apply to each item.
+            workers (int): Number of the worker threads.
+        """
+        self.stages.append(Stage(name, fn, workers, self.maxsize))
+
+    def run(self, items, callback=None):
+        """Put the items through all the stages.
+
+        Args:
+            items (iterable): Items to give to the first stage.
+            callback (callable, optional): Called with the output of the last
+                stage for each item.
+
+        Raises:
+            Exception: The first error raised in the stages.
+        """
+        assert self.stages, "Pipeline has no stages."
+        threads = []
+        for idx, stage in enumerate(self.stages):
+            next_stage = self.stages[idx + 1] \
+                if idx + 1 < len(self.stages) else None
+            for _ in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work, args=(stage, next_stage, callback),
+                    daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        first = self.stages[0]
+        for item in items:
+            if self.failed.is_set():
+                break
+            first.queue.put(item)
+        for _ in range(first.workers):
+            first.queue.put(_STOP)
+
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _work(self, stage, next_stage, callback):
+        while True:
+            depth = stage.queue.qsize()
+            item = stage.queue.get()
+            if item is _STOP:
+                break
+            if self.failed.is_set():
+                # keep draining so that the previous stages never block
+                continue
+            try:
+                start = time.perf_counter()
+                output = stage.fn(item)
+                stage.record(depth, time.perf_counter() - start)
+                if output is None:
+                    continue
+                if next_stage is not None:
+                    next_stage.queue.put(output)
+                elif callback is not None:
+                    callback(output)
+            except Exception as e:
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+                self.failed.set()
+
+        with stage.lock:
+            stage.running -= 1
+            last_worker = stage.running == 0
+        if last_worker and next_stage is not None:
+            for _ in range(next_stage.workers):
+                next_stage.queue.put(_STOP)
+
+    def stats(self):
+        """Statistics of all the stages.
+
+        Returns:
+            (dict): Stage names and their statistics.
+        """
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def report(self):
+        """Summary of the statistics to find the bottleneck.
+
+        The stage whose input queue is kept full is slower than the stages
+        before it.
+
+        Returns:
+            (str): One line for each stage.
+        """
+        lines = []
+        for name, stats in self.stats().items():
+            lines.append(
+                "{}: workers={} items={} busy={}s queue depth mean={} "
+                "max={}/{}".format(
+                    name, stats["workers"], stats["items"], stats["busy"],
+                    stats["mean_depth"], stats["max_depth"],
+                    stats["maxsize"]))
+        return "\n".join(lines)
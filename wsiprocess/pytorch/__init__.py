@@ -1,2 +1,2 @@
-from .wsidataset import WSIDataset, WSIsDataset
+from .wsidataset import WSIDataset, WSIsDataset, WSIMemmapDataset
 from .utils import ClassificationDataset, SegmentationDataset, main
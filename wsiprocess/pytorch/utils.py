@@ -5,7 +5,7 @@ import torch
 from torchvision import io
 
 import wsiprocess as wp
-from wsiprocess.cli import Args
+from wsiprocess.cli import Args, get_encoder
 
 
 class ClassificationDataset(torch.utils.data.Dataset):
@@ -59,7 +59,9 @@ class SegmentationDataset(torch.utils.data.Dataset):
 
 def main(command, foreground_fn):
     args = Args(command)
-    slide = wp.slide(args.wsi)
+    slide = wp.slide(
+        args.wsi, backend=args.backend, cache_size=args.cache_size*1024*1024,
+        openslide_cache_size=(args.openslide_cache_size or 0)*1024*1024)
     rule = wp.rule(args.rule) if hasattr(args, "rule") and args.rule else False
 
     if args.method == "evaluation":
@@ -112,9 +114,22 @@ def main(command, foreground_fn):
         no_patches=args.no_patches,
         crop_bbox=crop_bbox,
         verbose=args.verbose,
-        dryrun=args.dryrun)
+        dryrun=args.dryrun,
+        order=args.order,
+        object_centric=args.object_centric,
+        sample=args.sample,
+        seed=args.seed,
+        link=args.link,
+        encoder=get_encoder(args),
+        shards=args.shards,
+        shard_size=args.shard_size*1024*1024,
+        memmap=args.memmap)
     patcher.get_patch_parallel(
-        annotation.classes, max_workers=args.max_workers)
+        annotation.classes, max_workers=args.max_workers,
+        worker_type=args.worker_type,
+        stage_workers={"read": args.read_workers,
+                       "encode": args.encode_workers,
+                       "write": args.write_workers})
 
     if args.method == "detection":
         converter = wp.converter(
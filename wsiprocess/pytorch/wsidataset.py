@@ -2,6 +2,7 @@ import json
 from pathlib import Path
 from typing import Callable
 
+import numpy as np
 import openslide
 import torch
 from torchvision import io, transforms
@@ -9,6 +10,7 @@ import pandas as pd
 
 from wsiprocess import cli
 from wsiprocess.pytorch import utils
+from wsiprocess.shard import ShardReader
 
 
 class WSIDataset(torch.utils.data.Dataset):
@@ -41,12 +43,37 @@ class WSIDataset(torch.utils.data.Dataset):
         else:
             self.read_patch = self.read_patch_from_disk
             self.ext = self.patch_config["ext"]
+            self.read_manifest()
+            self.read_shard_index()
 
         self.read_coords()
 
     def read_coords(self):
         self.coords = pd.read_csv(self.path/"coords.csv")
 
+    def read_manifest(self):
+        # patches written once in the store, without the class directories
+        self.manifest = None
+        if self.patch_config.get("link") == "manifest":
+            manifest = pd.read_csv(self.path/"manifest.csv")
+            self.manifest = {
+                (x, y, label): path for x, y, label, path in zip(
+                    manifest["x"], manifest["y"], manifest["class"],
+                    manifest["path"])}
+
+    def read_shard_index(self):
+        # patches written into the shards, with index.csv to find them
+        self.shard_index = None
+        if self.patch_config.get("shards"):
+            index = pd.read_csv(self.path/"shards"/"index.csv")
+            index = index[index["field"] == "patch"]
+            self.shard_index = {
+                (x, y, label): (shard, offset, size)
+                for x, y, label, shard, offset, size in zip(
+                    index["x"], index["y"], index["class"], index["shard"],
+                    index["offset"], index["size"])}
+            self.shard_reader = ShardReader(self.path/"shards")
+
     def read_patch_from_wsi(self, **kwargs) -> torch.float32:
         x = kwargs["x"]
         y = kwargs["y"]
@@ -59,7 +86,17 @@ class WSIDataset(torch.utils.data.Dataset):
         x = kwargs["x"]
         y = kwargs["y"]
         label = kwargs.get("label") or "foreground"
-        path = str(self.path/"patches"/label/f"{x:06}_{y:06}.{self.ext}")
+        if self.shard_index is not None:
+            data = self.shard_reader.read(*self.shard_index[(x, y, label)])
+            patch = io.decode_image(
+                torch.frombuffer(bytearray(data), dtype=torch.uint8),
+                mode=io.ImageReadMode.RGB)/255
+            return patch
+        if self.manifest is not None:
+            path = str(self.path/self.manifest[(x, y, label)])
+        else:
+            path = str(
+                self.path/"patches"/label/f"{x:06}_{y:06}.{self.ext}")
         patch = io.read_image(path, mode=io.ImageReadMode.RGB)/255
         return patch
 
@@ -92,3 +129,30 @@ class WSIsDataset(torch.utils.data.Dataset):
         coord = self.coords.iloc[idx].to_dict()
         patch = self.datasets[coord["slide"]].read_patch(**coord)
         return patch
+
+
+class WSIMemmapDataset(torch.utils.data.Dataset):
+    """Patches written with `memmap=True`, read without decoding.
+
+    The array is mapped copy-on-write, and each item is a view of uint8 in
+    the shape of (3, H, W) on the page cache, not a copy. Convert it to
+    float after batching, ex: on the GPU.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        with open(self.path/"results.json", "r") as f:
+            self.patch_config = json.load(f)
+        self.coords = pd.read_csv(self.path/"memmap"/"index.csv")
+        self.patches = None
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, idx):
+        if self.patches is None:
+            # mapped in each worker of DataLoader
+            self.patches = np.load(
+                self.path/"memmap"/"patches.npy", mmap_mode="c")
+        row = int(self.coords["row"].iat[idx])
+        return torch.from_numpy(self.patches[row]).permute(2, 0, 1)
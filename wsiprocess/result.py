@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""Result store to accumulate the results of the patches in columns.
+
+A dict for each patch takes hundreds of bytes, and removing the duplicates
+through json strings takes minutes for millions of patches. ResultStore
+keeps the offsets and the sizes of the patches in chunks of numpy arrays,
+the classes as a bitmask, and the bounding boxes in a separate table with
+the offsets of the rows. Each thread appends to its own chunks without
+locking, and the duplicates are merged with packed integer keys.
+
+Example:
+    Accumulating the results:: python
+
+        from wsiprocess.result import ResultStore
+
+        store = ResultStore(["benign", "malignant"])
+        store.add(0, 0, 256, 256, classes=["benign"])
+        store.add(0, 0, 256, 256, classes=["malignant"])
+        for record in store.records("classification"):
+            print(record)
+"""
+import threading
+
+import numpy as np
+
+
+_ROW_DTYPES = {"x": np.int64, "y": np.int64, "w": np.int64, "h": np.int64,
+               "bb_start": np.int64, "bb_count": np.int64}
+_BB_DTYPES = {"x": np.int64, "y": np.int64, "w": np.int64, "h": np.int64,
+              "class": np.int32}
+
+
+class _Chunks:
+    """Columns of fixed types growing in chunks, used by a single thread."""
+
+    def __init__(self, dtypes, size, words=0):
+        self.dtypes = dtypes
+        self.size = size
+        self.words = words
+        self.full = []
+        self.count = 0
+        self.current = self.new_chunk()
+
+    def new_chunk(self):
+        chunk = {name: np.empty(self.size, dtype=dtype)
+                 for name, dtype in self.dtypes.items()}
+        if self.words:
+            chunk["mask"] = np.zeros((self.size, self.words), dtype=np.uint64)
+        return chunk
+
+    def __len__(self):
+        return sum(len(chunk["x"]) for chunk in self.full) + self.count
+
+    def append(self, values, mask=None):
+        if self.count == self.size:
+            self.full.append(self.current)
+            self.current = self.new_chunk()
+            self.count = 0
+        for name, value in values.items():
+            self.current[name][self.count] = value
+        if mask is not None:
+            self.current["mask"][self.count] = mask
+        self.count += 1
+
+    def arrays(self):
+        names = list(self.dtypes) + (["mask"] if self.words else [])
+        return {name: np.concatenate(
+            [chunk[name] for chunk in self.full] +
+            [self.current[name][:self.count]]) for name in names}
+
+
+class ResultStore:
+    """Columnar and thread-safe store of the results of the patches.
+
+    Args:
+        classes (list): Classes of the bitmask.
+        chunk_size (int): Number of the rows of a chunk.
+
+    Attributes:
+        classes (list): Classes of the bitmask.
+        words (int): Number of the 64 bit words of the bitmask.
+    """
+
+    def __init__(self, classes, chunk_size=4096):
+        self.classes = list(classes)
+        self.class_ids = {cls: i for i, cls in enumerate(self.classes)}
+        self.words = max(-(-len(self.classes) // 64), 1)
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.buffers = []
+        self.merged = None
+
+    def __str__(self):
+        return "wsiprocess.result.ResultStore {} rows".format(len(self))
+
+    def __getstate__(self):
+        # the results are sent with columns(), not with the store
+        return {"classes": self.classes, "chunk_size": self.chunk_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["classes"], state["chunk_size"])
+
+    def __len__(self):
+        if self.merged is not None:
+            return len(self.merged["x"])
+        return sum(len(rows) for rows, _ in self.buffers)
+
+    def buffer(self):
+        """Chunks of the rows and the bounding boxes of the current thread."""
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            buffer = (_Chunks(_ROW_DTYPES, self.chunk_size, self.words),
+                      _Chunks(_BB_DTYPES, self.chunk_size))
+            with self.lock:
+                self.buffers.append(buffer)
+                self.merged = None
+            self.local.buffer = buffer
+        return buffer
+
+    def bitmask(self, classes):
+        """Bitmask of the classes as 64 bit words."""
+        mask = np.zeros(self.words, dtype=np.uint64)
+        for cls in classes:
+            i = self.class_ids[cls]
+            mask[i // 64] |= np.uint64(1 << (i % 64))
+        return mask
+
+    def add(self, x, y, w, h, classes=(), bbs=()):
+        """Add the result of a patch.
+
+        Args:
+            x (int): X-axis offset of the patch.
+            y (int): Y-axis offset of the patch.
+            w (int): Width of the patch.
+            h (int): Height of the patch.
+            classes (list): Classes of the patch.
+            bbs (list): Bounding boxes on the patch as dicts of "x", "y",
+                "w", "h" and "class".
+        """
+        rows, boxes = self.buffer()
+        start = len(boxes)
+        for bb in bbs:
+            boxes.append({"x": bb["x"], "y": bb["y"], "w": bb["w"],
+                          "h": bb["h"], "class": self.class_ids[bb["class"]]})
+        rows.append({"x": x, "y": y, "w": w, "h": h, "bb_start": start,
+                     "bb_count": len(bbs)}, self.bitmask(classes))
+        if self.merged is not None:
+            with self.lock:
+                self.merged = None
+
+    def columns(self):
+        """All the rows and the bounding boxes as arrays.
+
+        Returns:
+            (tuple): Dict of the columns of the rows, and dict of the columns
+                of the bounding boxes. bb_start of the rows points to the rows
+                of the bounding boxes.
+        """
+        with self.lock:
+            buffers = list(self.buffers)
+        row_columns, bb_columns = [], []
+        offset = 0
+        for rows, boxes in buffers:
+            columns = rows.arrays()
+            columns["bb_start"] = columns["bb_start"] + offset
+            row_columns.append(columns)
+            bb_columns.append(boxes.arrays())
+            offset += len(boxes)
+        if not row_columns:
+            row_columns = [_Chunks(_ROW_DTYPES, 1, self.words).arrays()]
+            bb_columns = [_Chunks(_BB_DTYPES, 1).arrays()]
+        return ({name: np.concatenate([c[name] for c in row_columns])
+                 for name in row_columns[0]},
+                {name: np.concatenate([c[name] for c in bb_columns])
+                 for name in bb_columns[0]})
+
+    def pop_columns(self):
+        """Take out all the rows, such as in the worker processes.
+
+        Returns:
+            (tuple): Same as columns().
+        """
+        columns = self.columns()
+        with self.lock:
+            self.buffers = []
+            self.merged = None
+        self.local = threading.local()
+        return columns
+
+    def extend(self, columns):
+        """Add the rows taken out of another store with pop_columns().
+
+        Args:
+            columns (tuple): Columns from columns() or pop_columns().
+        """
+        row_columns, bb_columns = columns
+        # the arrays are kept as a full chunk, and nothing is appended
+        rows = _Chunks(_ROW_DTYPES, 0, self.words)
+        rows.full.append(row_columns)
+        boxes = _Chunks(_BB_DTYPES, 0)
+        boxes.full.append(bb_columns)
+        with self.lock:
+            self.buffers.append((rows, boxes))
+            self.merged = None
+
+    def merge(self):
+        """Merge the rows of the same patch.
+
+        The rows are sorted with the keys packed from the offsets and the
+        sizes, and the bitmasks of the rows of the same key are combined.
+        The bounding boxes of the first row are kept, after sorting the rows
+        also by their contents, so that the result does not depend on the
+        order the threads added them.
+
+        Returns:
+            (tuple): Same as columns(), with a row for each patch sorted by
+                x and y.
+        """
+        if self.merged is not None:
+            return self.merged, self.merged_bbs
+        rows, bbs = self.columns()
+        key = (rows["x"] << 32) | rows["y"]
+        sort_keys = [rows["mask"][:, i] for i in range(self.words)][::-1]
+        order = np.lexsort(
+            [rows["bb_count"]] + sort_keys + [rows["h"], rows["w"], key])
+        rows = {name: column[order] for name, column in rows.items()}
+        key = key[order]
+        first = np.ones(len(key), dtype=bool)
+        first[1:] = (key[1:] != key[:-1]) | \
+            (rows["w"][1:] != rows["w"][:-1]) | \
+            (rows["h"][1:] != rows["h"][:-1])
+        starts = np.flatnonzero(first)
+        merged = {name: column[starts] for name, column in rows.items()}
+        if len(starts):
+            merged["mask"] = np.bitwise_or.reduceat(
+                rows["mask"], starts, axis=0)
+        self.merged, self.merged_bbs = merged, bbs
+        return merged, bbs
+
+    def class_flags(self):
+        """Whether each merged row is on each class.
+
+        Returns:
+            (numpy.ndarray): Boolean matrix with the shape of
+                (rows, len(classes)).
+        """
+        rows, _ = self.merge()
+        ids = np.arange(len(self.classes))
+        words = rows["mask"][:, ids // 64]
+        bits = (ids % 64).astype(np.uint64)
+        return (words >> bits) & np.uint64(1) == 1
+
+    def records(self, method, mask_path=None):
+        """Results of the merged rows in the format of results.json.
+
+        Args:
+            method (str): One of {"evaluation", "classification",
+                "detection", "segmentation"}.
+            mask_path (callable, optional): Function of x, y and class to
+                make the path of a mask for segmentation.
+
+        Yields:
+            (dict): Result of a patch, or of a class of a patch for
+                classification.
+        """
+        rows, bbs = self.merge()
+        flags = self.class_flags()
+        columns = {name: rows[name].tolist()
+                   for name in ("x", "y", "w", "h", "bb_start", "bb_count")}
+        bb_columns = {name: column.tolist() for name, column in bbs.items()}
+        for i, (x, y, w, h) in enumerate(zip(
+                columns["x"], columns["y"], columns["w"], columns["h"])):
+            record = {"x": x, "y": y, "w": w, "h": h}
+            classes = [cls for cls, on in zip(self.classes, flags[i]) if on]
+            if method == "classification":
+                for cls in classes:
+                    yield dict(record, **{"class": cls})
+                continue
+            if method == "detection":
+                start = columns["bb_start"][i]
+                record["bbs"] = [
+                    {"x": bb_columns["x"][j],
+                     "y": bb_columns["y"][j],
+                     "w": bb_columns["w"][j],
+                     "h": bb_columns["h"][j],
+                     "class": self.classes[bb_columns["class"][j]]}
+                    for j in range(start, start + columns["bb_count"][i])]
+            elif method == "segmentation":
+                record["masks"] = [
+                    {"coords": mask_path(x, y, cls), "class": cls}
+                    for cls in classes]
+            yield record
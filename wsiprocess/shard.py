@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""Shard objects to write the patches into a few large files.
+
+Millions of small files are slow to create and to list on parallel
+filesystems. Shard writers append the encoded patches and masks to shards
+bounded in size, and return the shard and the offset of each of them to make
+an index. Tar shards follow the layout of WebDataset, where the files of a
+sample share the key and differ in the extension. HDF5 and zarr shards
+need h5py and zarr.
+
+Example:
+    Writing and reading a patch:: python
+
+        from wsiprocess.shard import get_shard_writer, ShardReader
+
+        writer = get_shard_writer("tar", "CMU-1/shards")
+        offsets = writer.write("CMU-1_001000_002000", {"jpg": data})
+        writer.close()
+        shard, offset, size = offsets["jpg"]
+        data = ShardReader("CMU-1/shards").read(shard, offset, size)
+"""
+import io
+import os
+import tarfile
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+class ShardWriter:
+    """Base class of the shard writers.
+
+    Subclasses implement open_shard(), append(), flush_shard() and
+    close_shard(). The worker processes keep their shards open over the
+    batches, and flush them after each batch. A shard closed with close() is
+    opened again to append when the next sample comes.
+
+    Args:
+        root (str): Directory to save the shards.
+        prefix (str): Prefix of the names of the shards.
+        max_size (int): Maximum bytes of a shard.
+        max_count (int, optional): Maximum number of the samples in a shard.
+
+    Attributes:
+        root (pathlib.Path): Directory to save the shards.
+        prefix (str): Prefix of the names of the shards.
+        max_size (int): Maximum bytes of a shard.
+        max_count (int): Maximum number of the samples in a shard.
+        tag (str): Added to the names of the shards to tell the writers of
+            the worker processes apart.
+        number (int): Number of the current shard.
+        size (int): Bytes written to the current shard.
+        count (int): Number of the samples in the current shard.
+    """
+
+    suffix = None
+
+    def __init__(self, root, prefix="shard", max_size=1 << 30,
+                 max_count=None):
+        self.root = Path(root)
+        self.prefix = prefix
+        self.max_size = max_size
+        self.max_count = max_count
+        self.tag = None
+        self.number = 0
+        self.size = 0
+        self.count = 0
+        self.handle = None
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "wsiprocess.shard.{} {}".format(
+            self.__class__.__name__, self.root)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["handle"] = None
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @property
+    def name(self):
+        """File name of the current shard."""
+        if self.tag is None:
+            return "{}-{:06}.{}".format(self.prefix, self.number, self.suffix)
+        return "{}-{}-{:06}.{}".format(
+            self.prefix, self.tag, self.number, self.suffix)
+
+    def write(self, key, fields):
+        """Append a sample to the current shard.
+
+        Args:
+            key (str): Key of the sample without dots.
+            fields (dict): Encoded data of the sample by the extension, ex:
+                {"jpg": data, "cls": b"benign"}.
+
+        Returns:
+            (dict): Shard, offset and size of the data by the extension.
+        """
+        size = sum(len(data) for data in fields.values())
+        with self.lock:
+            if self.count and (
+                    self.size + size > self.max_size or
+                    (self.max_count and self.count >= self.max_count)):
+                if self.handle is not None:
+                    self.close_shard()
+                    self.handle = None
+                self.number += 1
+                self.size = self.count = 0
+            if self.handle is None:
+                self.handle = self.open_shard(
+                    self.root/self.name, new=self.count == 0)
+            offsets = {}
+            for ext, data in fields.items():
+                offset = self.append("{}.{}".format(key, ext), data)
+                offsets[ext] = (self.name, offset, len(data))
+            self.size += size
+            self.count += 1
+        return offsets
+
+    def flush(self):
+        """Write the data of the current shard to the disk, keeping it
+        open."""
+        with self.lock:
+            if self.handle is not None:
+                self.flush_shard()
+
+    def close(self):
+        """Close the current shard. The next sample is appended to it."""
+        with self.lock:
+            if self.handle is not None:
+                self.close_shard()
+                self.handle = None
+
+    def open_shard(self, path, new):
+        raise NotImplementedError
+
+    def append(self, name, data):
+        raise NotImplementedError
+
+    def flush_shard(self):
+        raise NotImplementedError
+
+    def close_shard(self):
+        self.handle.close()
+
+
+class TarShardWriter(ShardWriter):
+    """Shards of tar, readable with WebDataset. The offsets point to the data
+    of the files in the tar."""
+
+    suffix = "tar"
+
+    def open_shard(self, path, new):
+        return tarfile.open(path, "w" if new else "a")
+
+    def append(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.handle.addfile(info, io.BytesIO(data))
+        blocks = -(-len(data) // tarfile.BLOCKSIZE)
+        return self.handle.offset - blocks * tarfile.BLOCKSIZE
+
+    def flush_shard(self):
+        # readable without the end-of-archive blocks written on close
+        self.handle.fileobj.flush()
+
+
+class HDF5ShardWriter(ShardWriter):
+    """Shards of HDF5. The data are the rows of a dataset "data" of variable
+    length, and the offsets are the indices of the rows. The datasets grow by
+    chunks, and are trimmed to the rows written on close."""
+
+    suffix = "h5"
+    chunk = 256
+
+    def open_shard(self, path, new):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("h5py not installed")
+        handle = h5py.File(path, "w" if new else "a")
+        if new:
+            handle.create_dataset(
+                "data", shape=(0,), maxshape=(None,), chunks=(self.chunk,),
+                dtype=h5py.vlen_dtype(np.uint8))
+            handle.create_dataset(
+                "name", shape=(0,), maxshape=(None,), chunks=(self.chunk,),
+                dtype=h5py.string_dtype())
+        self.rows = int(handle.attrs.get("rows", len(handle["data"])))
+        return handle
+
+    def append(self, name, data):
+        index = self.rows
+        if index == len(self.handle["data"]):
+            for dataset in ("data", "name"):
+                self.handle[dataset].resize((index + self.chunk,))
+        self.handle["data"][index] = np.frombuffer(data, np.uint8)
+        self.handle["name"][index] = name
+        self.rows += 1
+        return index
+
+    def flush_shard(self):
+        self.handle.attrs["rows"] = self.rows
+        self.handle.flush()
+
+    def close_shard(self):
+        for dataset in ("data", "name"):
+            self.handle[dataset].resize((self.rows,))
+        self.handle.attrs["rows"] = self.rows
+        self.handle.close()
+
+
+class ZarrShardWriter(ShardWriter):
+    """Shards of zarr. The data are the items of an array of bytes, and the
+    offsets are the indices of the items."""
+
+    suffix = "zarr"
+
+    def open_shard(self, path, new):
+        try:
+            import zarr
+            import numcodecs
+        except ImportError:
+            raise ImportError("zarr not installed")
+        if new:
+            return zarr.open(
+                str(path), mode="w", shape=(0,), chunks=(256,), dtype=object,
+                object_codec=numcodecs.VLenBytes())
+        return zarr.open(str(path), mode="a")
+
+    def append(self, name, data):
+        item = np.empty(1, dtype=object)
+        item[0] = data
+        self.handle.append(item)
+        return len(self.handle) - 1
+
+    def flush_shard(self):
+        # zarr writes the chunks on each append
+        pass
+
+    def close_shard(self):
+        pass
+
+
+SHARD_WRITERS = {
+    "tar": TarShardWriter, "hdf5": HDF5ShardWriter, "zarr": ZarrShardWriter}
+
+
+def get_shard_writer(name, root, **kwargs):
+    """Make a shard writer.
+
+    Args:
+        name (str): One of {"tar", "hdf5", "zarr"}.
+        root (str): Directory to save the shards.
+        **kwargs: Arguments of wsiprocess.shard.ShardWriter.
+
+    Returns:
+        (wsiprocess.shard.ShardWriter): The shard writer.
+    """
+    if name not in SHARD_WRITERS:
+        raise NotImplementedError("shards={} is not available".format(name))
+    return SHARD_WRITERS[name](root, **kwargs)
+
+
+class ShardReader:
+    """Random access to the data in the shards.
+
+    The shards are opened on the first read, and opened again in the forked
+    processes such as the workers of torch.utils.data.DataLoader.
+
+    Args:
+        root (str): Directory of the shards.
+
+    Attributes:
+        root (pathlib.Path): Directory of the shards.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.handles = {}
+        self.pid = os.getpid()
+
+    def __str__(self):
+        return "wsiprocess.shard.ShardReader {}".format(self.root)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["handles"] = {}
+        return state
+
+    def read(self, shard, offset, size):
+        """Read the data of a file in a shard.
+
+        Args:
+            shard (str): File name of the shard.
+            offset (int): Offset from the index.
+            size (int): Size from the index.
+
+        Returns:
+            (bytes): The data.
+        """
+        if self.pid != os.getpid():
+            self.handles = {}
+            self.pid = os.getpid()
+        handle = self.handles.get(shard)
+        if handle is None:
+            handle = self.handles[shard] = self.open(shard)
+        offset = int(offset)
+        if shard.endswith(".tar"):
+            handle.seek(offset)
+            return handle.read(int(size))
+        if shard.endswith(".h5"):
+            return handle["data"][offset].tobytes()
+        return handle[offset]
+
+    def open(self, shard):
+        path = self.root/shard
+        if shard.endswith(".tar"):
+            return open(path, "rb")
+        if shard.endswith(".h5"):
+            try:
+                import h5py
+            except ImportError:
+                raise ImportError("h5py not installed")
+            return h5py.File(path, "r")
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError("zarr not installed")
+        return zarr.open(str(path), mode="r")
+
+    def close(self):
+        for handle in self.handles.values():
+            if hasattr(handle, "close"):
+                handle.close()
+        self.handles = {}
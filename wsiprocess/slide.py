@@ -4,8 +4,13 @@ Slide is whole slide image, scanned with whole slide scanners.
 Mannually you can make pyramidical tiff file, which you can handle just the
 same as the scanned digital data, except for the magnification.
 """
+from .cache import TileCache
 from .error import SlideLoadError
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import os
+import threading
+import cv2
 import numpy as np
 from PIL import Image
 import openslide
@@ -17,27 +22,44 @@ class Slide:
     Args:
         path (str): Path to the whole slide image file.
         backend (str): Openslide or pyivps.
+        max_handles (int, optional): Maximum number of the openslide handles
+            opened for the worker threads. As default, the number of the CPUs.
+        cache_size (int, optional): Bytes of the decoded tiles to keep in the
+            tile cache. As default, the tile cache is not used.
+        tile_size (int, optional): Size of the tiles in the tile cache.
+        openslide_cache_size (int, optional): Bytes of the cache shared by the
+            openslide handles, if openslide supports it.
 
     Attributes:
         path (str): Path to the whole slide image file.
         slide (pyvips.Image): pyvips Image object.
         wsi_width (int): Width of slide.
         wsi_height (int): Height of slide.
+        handles (list): Openslide handles opened for the worker threads.
+        pid (int): ID of the process which opened the slide handle.
+        cache (wsiprocess.cache.TileCache): The tile cache. None if not used.
     """
 
-    def __init__(self, path, backend="openslide"):
+    def __init__(self, path, backend="openslide", max_handles=None,
+                 cache_size=0, tile_size=512, openslide_cache_size=None):
         self.path = path
         if not Path(path).exists():
             raise SlideLoadError("Slide File {} Not Found".format(path))
         self.filestem = Path(path).stem
         self.filename = Path(path).name
         self.backend = backend
+        self.max_handles = max_handles or os.cpu_count() or 1
+        self.cache = TileCache(cache_size) \
+            if cache_size and backend == "openslide" else None
+        self.tile_size = tile_size
+        self.openslide_cache_size = openslide_cache_size
 
         self.load_slide()
 
     def load_slide(self):
         if self.backend == "openslide":
-            self.slide = openslide.OpenSlide(self.path)
+            self.openslide_cache = self.make_openslide_cache()
+            self.slide = self.open_handle()
             self.width, self.height = self.slide.dimensions
         elif self.backend == "pyvips":
             try:
@@ -51,8 +73,93 @@ class Slide:
         else:
             raise NotImplementedError(
                 "backend={} is not available".format(self.backend))
+        self.pid = os.getpid()
+        self.handles = []
+        self.turn = 0
+        self.handles_lock = threading.Lock()
+        self.local = threading.local()
+        self.executor = None
         self.set_properties()
 
+    def make_openslide_cache(self):
+        """Make the cache for openslide if openslide_cache_size is set.
+
+        Returns:
+            (openslide.OpenSlideCache): The cache. None if openslide_cache_size
+                is not set or openslide does not support it.
+        """
+        if not self.openslide_cache_size:
+            return None
+        try:
+            return openslide.OpenSlideCache(self.openslide_cache_size)
+        except (AttributeError, openslide.OpenSlideError):
+            # openslide-python < 1.3 or OpenSlide < 4.0
+            return None
+
+    def open_handle(self):
+        handle = openslide.OpenSlide(self.path)
+        if self.openslide_cache is not None:
+            handle.set_cache(self.openslide_cache)
+        return handle
+
+    def get_handle(self):
+        """Get the slide handle for the current thread.
+
+        With openslide, each thread opens its own handle on the first call,
+        so that the threads do not contend on one handle and its cache. When
+        max_handles handles are opened, the threads after that share them in
+        turn. The main thread uses Slide.slide.
+
+        Returns:
+            (openslide.OpenSlide or pyvips.Image): The slide handle.
+        """
+        if self.backend != "openslide" or \
+                threading.current_thread() is threading.main_thread():
+            return self.slide
+        handle = getattr(self.local, "handle", None)
+        if handle is None:
+            with self.handles_lock:
+                if len(self.handles) < self.max_handles:
+                    handle = self.open_handle()
+                    self.handles.append(handle)
+                else:
+                    handle = self.handles[self.turn % len(self.handles)]
+                    self.turn += 1
+            self.local.handle = handle
+        return handle
+
+    def release_handles(self):
+        """Close the handles opened for the worker threads.
+
+        The threads open new handles if they read the slide again.
+        """
+        with self.handles_lock:
+            handles, self.handles = self.handles, []
+            self.local = threading.local()
+        for handle in handles:
+            handle.close()
+
+    def close(self):
+        """Close all the handles of the slide."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.release_handles()
+        if self.backend == "openslide":
+            self.slide.close()
+
+    def __getstate__(self):
+        # slide handles can not be shared between processes
+        state = self.__dict__.copy()
+        for key in ["slide", "handles", "handles_lock", "local",
+                    "openslide_cache", "executor"]:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load_slide()
+
     def __str__(self):
         return "wsiprocess.slide.Slide {} {}x{}".format(
             self.path, self.wsi_width, self.wsi_height)
@@ -88,6 +195,10 @@ class Slide:
 
         Attributes:
             magnification (int): Objective power of slide obj.
+            tile_width (int): Width of the tiles of the level 0. tile_size if
+                unknown.
+            tile_height (int): Height of the tiles of the level 0. tile_size if
+                unknown.
         """
         if self.backend == "openslide":
             properties = self.slide.properties
@@ -102,13 +213,354 @@ class Slide:
         if self.magnification:
             self.magnification = int(self.magnification)
 
-    def crop(self, x, y, w, h):
+        # tiles of the level 0, which are decoded at once
+        self.tile_width = int(properties.get(
+            "openslide.level[0].tile-width", self.tile_size))
+        self.tile_height = int(properties.get(
+            "openslide.level[0].tile-height", self.tile_size))
+
+    def crop(self, x, y, w, h, size=None):
+        """Crop a region of the slide.
+
+        Args:
+            x (int): X-axis offset of the region on the level 0.
+            y (int): Y-axis offset of the region on the level 0.
+            w (int): Width of the region on the level 0.
+            h (int): Height of the region on the level 0.
+            size (tuple, optional): Width and height of the output. If set,
+                the region is read from the pyramid level closest to the
+                output scale, and only the rest is resized.
+
+        Returns:
+            patch (PIL.Image.Image): Cropped region.
+        """
+        if size is not None and tuple(size) != (w, h):
+            return self.crop_resized(x, y, w, h, size)
         if self.backend == "openslide":
-            return self.slide.read_region((x, y), 0, (w, h))
+            return self.read_region(x, y, 0, w, h)
         elif self.backend == "pyvips":
-            patch = self.slide.crop(x, y, w, h)
-            patch = np.ndarray(
-                buffer=patch.write_to_memory(),
-                dtype=np.uint8,
-                shape=[patch.height, patch.width, patch.bands])
+            return Image.fromarray(self.crop_array(x, y, w, h))
+
+    def crop_array(self, x, y, w, h):
+        """Crop a region of the slide as numpy.ndarray.
+
+        With pyvips, the pixels are fetched through the region of the current
+        thread, without building a new pipeline for each crop.
+
+        Args:
+            x (int): X-axis offset of the region on the level 0.
+            y (int): Y-axis offset of the region on the level 0.
+            w (int): Width of the region on the level 0.
+            h (int): Height of the region on the level 0.
+
+        Returns:
+            patch (numpy.ndarray): Cropped region with the shape of (h, w, C).
+                It may be read-only.
+        """
+        if self.backend == "openslide":
+            return self.read_array(x, y, 0, w, h)
+        data = self.get_region().fetch(x, y, w, h)
+        return np.frombuffer(data, dtype=np.uint8).reshape(
+            h, w, self.slide.bands)
+
+    def get_region(self):
+        """Get the pyvips region for the current thread.
+
+        Returns:
+            (pyvips.Region): The region of the slide.
+        """
+        region = getattr(self.local, "region", None)
+        if region is None:
+            import pyvips
+            region = pyvips.Region.new(self.slide)
+            self.local.region = region
+        return region
+
+    def crop_resized(self, x, y, w, h, size):
+        """Crop a region of the slide and resize it to the output size.
+
+        The region is read from the level with the largest downsample not
+        exceeding the requested one, so that the pixels to read and decode
+        are reduced, and the rest is resized with area averaging.
+
+        Args:
+            x (int): X-axis offset of the region on the level 0.
+            y (int): Y-axis offset of the region on the level 0.
+            w (int): Width of the region on the level 0.
+            h (int): Height of the region on the level 0.
+            size (tuple): Width and height of the output.
+
+        Returns:
+            patch (PIL.Image.Image): Cropped and resized region.
+        """
+        size = tuple(size)
+        downsample = min(w / size[0], h / size[1])
+        if self.backend == "openslide" and downsample > 1:
+            level = self.slide.get_best_level_for_downsample(downsample)
+            level_downsample = self.slide.level_downsamples[level]
+            patch = self.read_array(
+                x, y, level,
+                max(round(w / level_downsample), 1),
+                max(round(h / level_downsample), 1))
+        else:
+            patch = self.crop_array(x, y, w, h)
+        if patch.shape[1::-1] == size:
             return Image.fromarray(patch)
+        if patch.shape[1] > size[0]:
+            interpolation = cv2.INTER_AREA
+        else:
+            interpolation = cv2.INTER_LINEAR
+        patch = cv2.resize(patch, size, interpolation=interpolation)
+        return Image.fromarray(patch)
+
+    def read_region(self, x, y, level, w, h):
+        """Read a region with openslide, through the tile cache if it is used.
+
+        Args:
+            x (int): X-axis offset of the region on the level 0.
+            y (int): Y-axis offset of the region on the level 0.
+            level (int): Level to read from.
+            w (int): Width of the region on the level.
+            h (int): Height of the region on the level.
+
+        Returns:
+            region (PIL.Image.Image): RGBA image of the region.
+        """
+        if not self.use_cache(level):
+            _, _, x, y = self.level_offsets(x, y, level)
+            return self.get_handle().read_region((x, y), level, (w, h))
+        return Image.fromarray(self.read_array(x, y, level, w, h), "RGBA")
+
+    def level_offsets(self, x, y, level):
+        """Offsets of a region on a level, and the level-0 offsets to read it.
+
+        A region on a level starts at the level pixel int(x / downsample),
+        and is read from the level-0 offsets rounded from the level pixel,
+        the same as the tiles of the tile cache. Openslide interpolates a
+        region by the fraction of a pixel between them, which is 0 where the
+        downsample is an integer.
+
+        Args:
+            x (int): X-axis offset of the region on the level 0.
+            y (int): Y-axis offset of the region on the level 0.
+            level (int): Level to read from.
+
+        Returns:
+            (tuple): X-axis and Y-axis offsets on the level, and on the
+                level 0.
+        """
+        downsample = self.slide.level_downsamples[level]
+        left = int(x / downsample)
+        top = int(y / downsample)
+        return left, top, round(left * downsample), round(top * downsample)
+
+    def use_cache(self, level):
+        """Whether the regions on a level are read through the tile cache.
+
+        Only the levels of integer downsamples are cached, where the tiles
+        start on the level pixels without interpolation, so that the cached
+        regions are the same as the regions read directly.
+
+        Args:
+            level (int): Level to read from.
+
+        Returns:
+            (bool): Whether the tile cache is used.
+        """
+        return self.cache is not None and \
+            float(self.slide.level_downsamples[level]).is_integer()
+
+    def read_array(self, x, y, level, w, h):
+        """Read a region with openslide as numpy.ndarray.
+
+        With the tile cache, the region is copied from the cached tiles
+        without making a PIL image. The region starts on the level pixel
+        from level_offsets() with or without the cache.
+
+        Args:
+            x (int): X-axis offset of the region on the level 0.
+            y (int): Y-axis offset of the region on the level 0.
+            level (int): Level to read from.
+            w (int): Width of the region on the level.
+            h (int): Height of the region on the level.
+
+        Returns:
+            region (numpy.ndarray): RGBA region with the shape of (h, w, 4).
+        """
+        left, top, x, y = self.level_offsets(x, y, level)
+        if not self.use_cache(level):
+            return np.asarray(
+                self.get_handle().read_region((x, y), level, (w, h)))
+        size = self.tile_size
+        region = np.empty((h, w, 4), dtype=np.uint8)
+        for ty in range(top // size, (top + h - 1) // size + 1):
+            for tx in range(left // size, (left + w - 1) // size + 1):
+                tile = self.get_tile(level, tx, ty)
+                x0 = max(tx * size, left)
+                x1 = min((tx + 1) * size, left + w)
+                y0 = max(ty * size, top)
+                y1 = min((ty + 1) * size, top + h)
+                region[y0 - top:y1 - top, x0 - left:x1 - left] = tile[
+                    y0 - ty * size:y1 - ty * size,
+                    x0 - tx * size:x1 - tx * size]
+        return region
+
+    def get_tile(self, level, tx, ty):
+        """Get a tile of the tile cache.
+
+        Args:
+            level (int): Level of the tile.
+            tx (int): Index of the tile along the x-axis.
+            ty (int): Index of the tile along the y-axis.
+
+        Returns:
+            tile (numpy.ndarray): RGBA tile with the shape of
+                (tile_size, tile_size, 4).
+        """
+        def read_tile():
+            # only the levels of integer downsamples are cached
+            downsample = int(self.slide.level_downsamples[level])
+            tile = self.get_handle().read_region(
+                (tx * self.tile_size * downsample,
+                 ty * self.tile_size * downsample),
+                level, (self.tile_size, self.tile_size))
+            return np.asarray(tile)
+        return self.cache.get((level, tx, ty), read_tile)
+
+    def crop_many(self, coords, size, level=0, out=None):
+        """Crop many regions of the same size into a batch.
+
+        The regions are read in parallel on the threads of the slide, and
+        written into one array, dropping the alpha channel. No PIL image is
+        made for the pyvips backend and for the tile cache.
+
+        Args:
+            coords (array_like): X-axis and Y-axis offsets of the regions on
+                the level 0, with the shape of (N, 2).
+            size (tuple): Width and height of the regions on the level.
+            level (int, optional): Level to read from. Only the level 0 is
+                available for pyvips.
+            out (numpy.ndarray, optional): Array to write the regions into,
+                with the shape of (N, height, width, 3) or larger, to reuse
+                it over the calls without allocating. As default, a new array
+                is allocated for each call.
+
+        Returns:
+            batch (numpy.ndarray): Regions with the shape of
+                (N, height, width, 3) in uint8. A view of out if it is given,
+                which the next call with the same out overwrites.
+        """
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+        w, h = size
+        if self.backend == "pyvips" and level != 0:
+            raise NotImplementedError(
+                "level={} is not available with pyvips".format(level))
+        if out is None:
+            out = np.empty((len(coords), h, w, 3), dtype=np.uint8)
+        elif len(out) < len(coords) or out.shape[1:] != (h, w, 3):
+            raise ValueError("out of {} can not hold {} regions of {}".format(
+                out.shape, len(coords), (h, w, 3)))
+        batch = out[:len(coords)]
+
+        def read(idx):
+            x, y = coords[idx]
+            if self.backend == "openslide":
+                region = self.read_array(int(x), int(y), level, w, h)
+            else:
+                region = self.crop_array(int(x), int(y), w, h)
+            batch[idx] = region[..., :3]
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_handles)
+        for _ in self.executor.map(read, range(len(coords))):
+            pass
+        return batch
+
+    def scan_rows(self, tops, height, width=None, left=0):
+        """Read the rows of the slide from the top to the bottom.
+
+        With pyvips, the slide is opened with sequential access, which
+        decodes the slide as a stream with a bounded cache instead of
+        decoding the tiles at random. Slides that can not be read
+        sequentially are read with random access. Each row is read once even
+        if the bands overlap, and only one band is kept in the memory. Only
+        the columns from left to left + width are read.
+
+        Args:
+            tops (iterable): Y-axis offsets of the bands in ascending order.
+            height (int): Height of the bands.
+            width (int, optional): Width of the bands. The area outside of the
+                slide is filled with 0. As default, the width of the slide
+                from left.
+            left (int, optional): X-axis offset of the bands.
+
+        Yields:
+            (tuple): Y-axis offset of the band and the band as numpy.ndarray
+                with the shape of (height, width, C).
+        """
+        width = width or self.width - left
+        # columns of the bands inside of the slide
+        span = max(min(width, self.width - left), 0)
+        fetch = self.sequential_fetch()
+        band, band_top = None, None
+        for top in tops:
+            if band is not None and top < band_top:
+                raise ValueError("tops must be in ascending order")
+            bottom = min(top + height, self.height)
+            if band is not None and top < band_top + len(band):
+                keep = band[top - band_top:]
+            else:
+                keep = None
+            start = top + (0 if keep is None else len(keep))
+            parts = [] if keep is None else [keep]
+            if bottom > start and span:
+                try:
+                    rows = fetch(left, start, span, bottom - start)
+                except Exception:
+                    if fetch == self.random_fetch:
+                        raise
+                    fetch = self.random_fetch
+                    rows = fetch(left, start, span, bottom - start)
+                parts.append(rows)
+            if parts:
+                band = np.concatenate(parts) if len(parts) > 1 else parts[0]
+            else:
+                band = np.zeros((0, span, 1), dtype=np.uint8)
+            band_top = top
+            yield top, self.pad_band(band, height, width)
+
+    @staticmethod
+    def pad_band(band, height, width):
+        if band.shape[:2] == (height, width):
+            return band
+        padded = np.zeros((height, width, band.shape[2]), dtype=np.uint8)
+        h, w = min(len(band), height), min(band.shape[1], width)
+        padded[:h, :w] = band[:h, :w]
+        return padded
+
+    def sequential_fetch(self):
+        """Get the function to fetch the rows of the slide sequentially.
+
+        Returns:
+            (callable): Function to fetch the rows of the given offsets,
+                width and height. random_fetch if the slide can not be opened
+                with sequential access.
+        """
+        if self.backend != "pyvips":
+            return self.random_fetch
+        import pyvips
+        try:
+            image = pyvips.Image.new_from_file(self.path, access="sequential")
+            region = pyvips.Region.new(image)
+        except pyvips.Error:
+            return self.random_fetch
+
+        def fetch(left, top, width, height):
+            data = region.fetch(left, top, width, height)
+            return np.frombuffer(data, dtype=np.uint8).reshape(
+                height, width, image.bands)
+        return fetch
+
+    def random_fetch(self, left, top, width, height):
+        """Fetch the rows of the slide with random access."""
+        return self.crop_array(left, top, width, height)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Spatial index to find the bounding boxes on a patch.
+
+Annotations of the cells and the mitoses have tens of thousands of small
+objects. BoxIndex packs their bounding boxes into arrays once, and puts them
+into the buckets of a uniform grid, so that a query looks into the boxes
+near the patch only.
+
+Example:
+    Finding the boxes on a patch:: python
+
+        from wsiprocess.spatial import BoxIndex, pack_boxes
+
+        boxes = pack_boxes(annotation.mask_coords["mitosis"])
+        index = BoxIndex(boxes, cell_size=256)
+        indices = index.query(1000, 2000, 1256, 2256)
+"""
+import numpy as np
+
+
+def pack_boxes(coords):
+    """Bounding boxes of the polygons.
+
+    Args:
+        coords (list): Polygons as lists of [x, y], such as
+            Annotation.mask_coords[cls]. They are not modified.
+
+    Returns:
+        boxes (numpy.ndarray): Left, top, right and bottom of the boxes with
+            the shape of (N, 4).
+    """
+    if len(coords) == 0:
+        return np.zeros((0, 4))
+    try:
+        points = np.asarray(coords)
+        assert points.ndim == 3
+        return np.concatenate(
+            [points.min(axis=1), points.max(axis=1)], axis=1)
+    except (ValueError, AssertionError):
+        # polygons with the different number of the points
+        return np.array([
+            np.concatenate([np.min(coord, axis=0), np.max(coord, axis=0)])
+            for coord in map(np.asarray, coords)])
+
+
+class BoxIndex:
+    """Uniform grid of buckets of the bounding boxes.
+
+    A box is put into all the buckets it overlaps. Boxes overlapping too many
+    buckets are kept aside and checked on every query.
+
+    Args:
+        boxes (numpy.ndarray): Left, top, right and bottom of the boxes with
+            the shape of (N, 4).
+        cell_size (int): Width and height of the buckets.
+        max_cells (int): Maximum number of the buckets for a box.
+
+    Attributes:
+        boxes (numpy.ndarray): The boxes.
+        cell_size (int): Width and height of the buckets.
+        large (numpy.ndarray): Indices of the boxes kept aside.
+    """
+
+    def __init__(self, boxes, cell_size, max_cells=64):
+        self.boxes = np.asarray(boxes).reshape(-1, 4)
+        self.cell_size = max(int(cell_size), 1)
+        cells = np.floor_divide(self.boxes, self.cell_size).astype(np.int64)
+        self.origin = cells[:, :2].min(axis=0) if len(cells) else \
+            np.zeros(2, dtype=np.int64)
+        cells[:, :2] -= self.origin
+        cells[:, 2:] -= self.origin
+        self.columns = int(cells[:, 2].max()) + 1 if len(cells) else 1
+        counts = (cells[:, 2] - cells[:, 0] + 1) * \
+            (cells[:, 3] - cells[:, 1] + 1)
+        small = counts <= max_cells
+        self.large = np.flatnonzero(~small)
+
+        # pairs of the bucket and the box, sorted by the bucket
+        ids = np.flatnonzero(small)
+        widths = cells[ids, 2] - cells[ids, 0] + 1
+        members = np.repeat(ids, counts[ids])
+        starts = np.repeat(np.cumsum(counts[ids]) - counts[ids], counts[ids])
+        offsets = np.arange(len(members)) - starts
+        dy, dx = np.divmod(offsets, np.repeat(widths, counts[ids]))
+        buckets = (cells[members, 1] + dy) * self.columns + \
+            cells[members, 0] + dx
+        order = np.argsort(buckets, kind="stable")
+        self.buckets = buckets[order]
+        self.members = members[order]
+
+    def __str__(self):
+        return "wsiprocess.spatial.BoxIndex {} boxes".format(len(self.boxes))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def query(self, left, top, right, bottom):
+        """Find the boxes intersecting a rectangle, including the edges.
+
+        Args:
+            left (int): Left of the rectangle.
+            top (int): Top of the rectangle.
+            right (int): Right of the rectangle.
+            bottom (int): Bottom of the rectangle.
+
+        Returns:
+            indices (numpy.ndarray): Indices of the boxes in ascending order.
+        """
+        if len(self.boxes) == 0:
+            return np.zeros(0, dtype=np.int64)
+        x0, y0 = np.floor_divide([left, top], self.cell_size) - self.origin
+        x1, y1 = np.floor_divide([right, bottom], self.cell_size) - \
+            self.origin
+        x0, x1 = max(x0, 0), min(x1, self.columns - 1)
+        y0 = max(y0, 0)
+        candidates = [self.large]
+        if x0 <= x1:
+            for row in range(y0, y1 + 1):
+                start, stop = np.searchsorted(
+                    self.buckets,
+                    [row * self.columns + x0, row * self.columns + x1 + 1])
+                candidates.append(self.members[start:stop])
+        candidates = np.unique(np.concatenate(candidates))
+        boxes = self.boxes[candidates]
+        on = (boxes[:, 0] <= right) & (left <= boxes[:, 2]) & \
+            (boxes[:, 1] <= bottom) & (top <= boxes[:, 3])
+        return candidates[on]